@@ -22,18 +22,36 @@
 # <https://github.com/EdwardBetts/depicts>, under GPL-3 license.
 
 import os
+import json
+import time
 import yaml
 import mwoauth
-import roman
-from math import ceil
-from flask_thumbnails import Thumbnail
+import requests
+from urllib.parse import quote, unquote
 from requests_oauthlib import OAuth1Session
 import wikidata_oauth
-from flask import Flask, render_template, flash, request, redirect, url_for, session, g
+import catalog
+import coalesce
+import cooperative
+import fanout
+import thumbnails
+import throttle
+from prefetch import Prefetcher
+from edit_queue import EditQueue
+import http_client
+import labels
+import metrics
+import progress
+import query
+import search
+import sparql
+from flask import Flask, render_template, flash, request, redirect, url_for, session, g, jsonify, abort, send_file,\
+    Response, make_response
 from flask_babel import Babel
+from werkzeug.http import HTTP_STATUS_CODES
 from query import per_instance, per_collection, per_creator, per_decade, per_depict,\
-    works_of_instance, works_in_collection, works_of_creator, works_of_decade,work_depicts,\
-    collection_data, creator_data, work_data, get_p180, get_next_qid, works_of_depict,\
+    works_of_instance, works_in_collection, works_of_creator, works_of_decade,\
+    collection_data, creator_data, get_item, get_next_qid, works_of_depict,\
     get_name, get_tutorial_collections, get_tutorial_images, get_tutorial_total_qids, total_works
 
 
@@ -41,26 +59,46 @@ __dir__ = os.path.dirname(__file__)
 app = Flask(__name__)
 app.config.update(yaml.safe_load(open(os.path.join(__dir__, 'config.yaml'))))
 BABEL = Babel(app)
-thumb = Thumbnail(app)
 consumer_token = mwoauth.ConsumerToken(
     app.config['CONSUMER_KEY'],
     app.config['CONSUMER_SECRET'])
 WIKIDATA_API_ENDPOINT = 'https://www.wikidata.org/w/api.php'
-THUMBNAIL_SIZE = '300px'
+THUMBNAIL_SIZE = 300
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+THUMBNAILS = thumbnails.ThumbnailCache(app.config.get('THUMBNAIL_CACHE_DIR', os.path.join(__dir__, 'thumbnails')),
+                                       app.config.get('THUMBNAIL_CACHE_SIZE', 1024 ** 3))
+ROUTE_DEADLINE = app.config.get('ROUTE_DEADLINE', 25)
+EDITS = EditQueue(app.config.get('EDIT_QUEUE_PATH', os.path.join(__dir__, 'edits.sqlite3')),
+                  lambda qid, quantities, credentials: set_quantities(qid, quantities, credentials))
+EDITS.callbacks.append(lambda qid, quantities: query.forget_item(qid, app.config['LANGUAGES']))
+PROGRESS = progress.ProgressTracker()
+EDITS.callbacks.append(PROGRESS.record)
+EDITS.start(app, app.config.get('EDIT_WORKERS', 2))
+PREFETCHER = Prefetcher(app.config.get('PREFETCH_WORKERS', 2))
+UPSTREAM_ERRORS = (requests.RequestException, query.ApiError)
+ANONYMOUS_ENDPOINTS = ("static", "thumbnail", "metrics_export", "api_search", "api_progress")
+http_client.configure(app.config)
+throttle.configure(app.config)
+coalesce.configure(app.config)
+fanout.configure(app.config)
+if cooperative.patched():
+    cooperative.configure(app.config)
+query.CACHE.maxsize = app.config.get('QUERY_CACHE_SIZE', 512)
+query.DECK.prioritize = app.config.get('DECK_PRIORITIZE_UNCOUNTED', False)
+catalog.start(app.config.get('CATALOG_REFRESH_INTERVAL', 21600), app.config.get('CATALOG_SYNC_INTERVAL', 600))
 
 
 def get_locale(lang=None):
     if lang is not None:
         return lang
     else:
-        try:
-            lang = session["language"]
-        except KeyError:
-            lang = None
-
-        if lang is not None:
+        # The views are materialized only for the listed languages
+        lang = session.get("language")
+        if lang in app.config["LANGUAGES"]:
             return lang
-        return request.accept_languages.best_match(app.config["LANGUAGES"])
+        return request.accept_languages.best_match(app.config["LANGUAGES"],
+                                                   default=app.config.get('BABEL_DEFAULT_LOCALE', "pt"))
 
 
 BABEL.init_app(app, locale_selector=get_locale)
@@ -70,12 +108,12 @@ BABEL.init_app(app, locale_selector=get_locale)
 def set_locale():
     langs = ["pt?", "en?"]
     next_page = request.args.get('return_to')
+    lang = request.args.get('lang')
+    if lang not in app.config["LANGUAGES"]:
+        return redirect(next_page)
     lang_from = next_page.split("/")[-1]
     if lang_from in langs:
-        lang = request.args.get('lang')
         next_page = "/".join(next_page.split("/")[:-1])+"/"+lang
-    else:
-        lang = request.args.get('lang')
     session["language"] = lang
     return redirect(next_page)
 
@@ -86,11 +124,26 @@ def set_locale():
 @app.before_request
 def init_profile():
     g.profiling = []
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def send_profile(response):
+    if "started" in g:
+        duration = time.perf_counter() - g.started
+        metrics.observe_route(request.endpoint or "unmatched", response.status_code, duration)
+        if app.config.get('SERVER_TIMING', True):
+            response.headers["Server-Timing"] = metrics.server_timing(g.profiling, duration)
+    return response
 
 
 @app.before_request
 def global_user():
-    g.user = wikidata_oauth.get_username()
+    # Static files, images and anonymous visitors need no identity
+    if request.endpoint in ANONYMOUS_ENDPOINTS or 'owner_key' not in session:
+        g.user = None
+    else:
+        g.user = wikidata_oauth.get_username()
 
 
 @app.route('/login')
@@ -141,6 +194,10 @@ def oauth_callback():
     oauth_tokens = oauth.fetch_access_token(access_token_url)
     session['owner_key'] = oauth_tokens.get('oauth_token')
     session['owner_secret'] = oauth_tokens.get('oauth_token_secret')
+    session.pop('username', None)
+    username = wikidata_oauth.get_username()
+    if username:
+        EDITS.resume(username, (session['owner_key'], session['owner_secret']))
 
     next_page = session.get('after_login')
     return redirect(next_page)
@@ -152,6 +209,8 @@ def logout():
     if next_page:
         session['after_logout'] = next_page
 
+    if 'owner_key' in session:
+        wikidata_oauth.forget_session(session['owner_key'])
     for key in 'owner_key', 'owner_secret', 'username', 'after_login':
         if key in session:
             del session[key]
@@ -190,38 +249,74 @@ def logout():
 @app.errorhandler(504)
 @app.errorhandler(505)
 def page_not_found(e):
+    if request.path.startswith("/api/"):
+        code = e.code
+        # Failures of Wikidata reach the handler as internal errors
+        if isinstance(getattr(e, "original_exception", None), UPSTREAM_ERRORS):
+            code = 502
+        return api_error(code)
     return render_template('error.html', lang=get_locale())
 
 
+@app.errorhandler(throttle.Throttled)
+def wdqs_throttled(e):
+    if request.path.startswith("/api/"):
+        response = api_error(503)
+    else:
+        response = make_response(render_template('error.html', lang=get_locale()), 503)
+    response.headers["Retry-After"] = str(int(e.retry_after) + 1)
+    return response
+
+
+@app.errorhandler(fanout.DeadlineExceeded)
+def route_deadline_exceeded(e):
+    app.logger.warning(str(e))
+    if request.path.startswith("/api/"):
+        return api_error(504)
+    return make_response(render_template('error.html', lang=get_locale()), 504)
+
+
+def api_error(code):
+    # The JSON API answers its errors in JSON, with their status, so the scripts of the pages can tell them apart
+    response = jsonify({"error": HTTP_STATUS_CODES.get(code, "Error"), "status": code})
+    response.status_code = code
+    return response
+
+
 @app.route('/', methods=['GET'])
 def museudoipiranga():
-    username = wikidata_oauth.get_username()
+    username = g.user
     return render_template("museudoipiranga.html", username=username, lang=get_locale())
 
 
 @app.route('/about', methods=['GET'])
 @app.route('/sobre', methods=['GET'])
 def sobre():
-    username = wikidata_oauth.get_username()
+    username = g.user
     number_works = total_works()
     return render_template("sobre.html", username=username, number_works=number_works, lang=get_locale())
 
 
 @app.route('/tutorial', methods=['GET'])
 def tutorial():
-    username = wikidata_oauth.get_username()
-    collection_ = get_tutorial_collections()
-    images_ = get_tutorial_images()
-    total = get_tutorial_total_qids()
-    total_collection = get_tutorial_total_qids("; wdt:P195 wd:Q56677463.")
+    username = g.user
+    results = fanout.gather({"collections": (get_tutorial_collections,),
+                             "images": (get_tutorial_images,),
+                             "total": (get_tutorial_total_qids,),
+                             "total_collection": (get_tutorial_total_qids, "Q56677463")},
+                            ROUTE_DEADLINE, {"total": "", "total_collection": ""})
+    collection_ = results["collections"]
+    images_ = results["images"]
+    total = results["total"]
+    total_collection = results["total_collection"]
 
     collections=[]
-    for result in collection_["results"]["bindings"]:
-        collections.append({"label": result["collection_label"]["value"]})
+    for row in collection_:
+        collections.append({"label": row.collection_label})
 
     collection_tutorial = []
-    for result in images_["results"]["bindings"]:
-        collection_tutorial.append({"image": result["image"]["value"]+"?width="+THUMBNAIL_SIZE})
+    for row in images_:
+        collection_tutorial.append({"image": url_for("thumbnail", width=THUMBNAIL_SIZE, filename=unquote(row.image))})
 
     return render_template("tutorial.html",
                            username=username,
@@ -235,7 +330,7 @@ def tutorial():
 
 @app.route('/apps')
 def apps():
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
     return render_template('apps.html',
                            username=username,
@@ -246,15 +341,18 @@ def apps():
 @app.route('/collections', methods=['GET'])
 @app.route('/coleções', methods=['GET'])
 def show_per_collection():
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    json = per_collection(lang)
-    collections = []
-    for result in json["results"]["bindings"]:
-        collections.append({
-            "qid": result["collection"]["value"].split("/")[-1],
-            "label": result["collection_label"]["value"],
-            "quantity": result["num_works"]["value"]})
+    rows = per_collection(lang)
+    # None while the view is computed for the first time
+    collections = None
+    if rows is not None:
+        collections = []
+        for row in rows:
+            collections.append({
+                "qid": row.collection,
+                "label": row.collection_label,
+                "quantity": row.num_works})
     return render_template("per_collection.html", collections=collections, username=username, lang=lang, collection="")
 
 
@@ -262,31 +360,29 @@ def show_per_collection():
 @app.route('/collection/<qid>', methods=['GET'])
 @app.route('/coleção/<qid>', methods=['GET'])
 def show_works_in_collection(qid):
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    json = works_in_collection(qid)
-    collection = []
-    collection_data_ = collection_data(qid, lang)
-
-    for result in json["results"]["bindings"]:
-        collection.append({
-            "qid": result["work"]["value"].split("/")[-1],
-            "image": result["image"]["value"][51:],
-            "label": result["work_label"]["value"]})
+    results = fanout.gather({"works": (works_in_collection, qid),
+                             "data": (collection_data, qid, lang)},
+                            ROUTE_DEADLINE)
+    collection = works_list(results["works"])
+    collection_data_ = results["data"][0]
 
     coll_data = {
-        "collection_label": collection_data_["results"]["bindings"][0]["collection_label"]["value"],
-        "total": collection_data_["results"]["bindings"][0]["total"]["value"],
+        "collection_label": collection_data_.collection_label,
+        "total": collection_data_.total,
         "total_scope": len(collection),
-        "collection_article": collection_data_["results"]["bindings"][0]["collection_article"]["value"] if "collection_article" in collection_data_["results"]["bindings"][0] else "",
-        "collection_category": collection_data_["results"]["bindings"][0]["collection_category"]["value"] if "collection_category" in collection_data_["results"]["bindings"][0] else "",
-        "named_after": collection_data_["results"]["bindings"][0]["named_after"]["value"] if "named_after" in collection_data_["results"]["bindings"][0] else "",
-        "named_after_label": collection_data_["results"]["bindings"][0]["named_after_label"]["value"] if "named_after_label" in collection_data_["results"]["bindings"][0] else "",
-        "named_after_article": collection_data_["results"]["bindings"][0]["named_after_article"]["value"] if "named_after_article " in collection_data_["results"]["bindings"][0] else ""
+        "collection_article": collection_data_.collection_article,
+        "collection_category": collection_data_.collection_category,
+        "named_after": collection_data_.named_after,
+        "named_after_label": collection_data_.named_after_label,
+        "named_after_article": collection_data_.named_after_article
     }
 
     return render_template("per_collection.html",
-                           collection=collection,
+                           collection=collection[:PAGE_SIZE],
+                           total=len(collection),
+                           api_url=url_for("api_works", facet="collection", value=qid),
                            qid=qid,
                            username=username,
                            collection_data=coll_data,
@@ -298,15 +394,17 @@ def show_works_in_collection(qid):
 @app.route('/creators', methods=['GET'])
 @app.route('/criadores', methods=['GET'])
 def show_per_creator():
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    json = per_creator(lang)
-    creators = []
-    for result in json["results"]["bindings"]:
-        creators.append({
-            "qid": result["creator"]["value"].split("/")[-1],
-            "label": result["creator_label"]["value"],
-            "quantity": result["total"]["value"]})
+    rows = per_creator(lang)
+    creators = None
+    if rows is not None:
+        creators = []
+        for row in rows:
+            creators.append({
+                "qid": row.creator,
+                "label": row.creator_label,
+                "quantity": row.total})
     return render_template("per_creator.html", creators=creators, username=username, lang=lang, creator="")
 
 
@@ -314,27 +412,25 @@ def show_per_creator():
 @app.route('/creator/<qid>', methods=['GET'])
 @app.route('/criador/<qid>', methods=['GET'])
 def show_works_of_creator(qid):
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    json = works_of_creator(qid)
-    creator = []
-    creator_data_ = creator_data(qid, lang)
-
-    for result in json["results"]["bindings"]:
-        creator.append({
-            "qid": result["work"]["value"].split("/")[-1],
-            "label": result["work_label"]["value"],
-            "image": result["image"]["value"][51:]})
+    results = fanout.gather({"works": (works_of_creator, qid),
+                             "data": (creator_data, qid, lang)},
+                            ROUTE_DEADLINE)
+    creator = works_list(results["works"])
+    creator_data_ = results["data"][0]
 
     creator_data_aux = {
-        "creator_article": creator_data_["results"]["bindings"][0]["creator_article"]["value"] if "creator_article" in creator_data_["results"]["bindings"][0] else "",
-        "creator_label": creator_data_["results"]["bindings"][0]["creator_label"]["value"],
-        "total": creator_data_["results"]["bindings"][0]["total"]["value"],
+        "creator_article": creator_data_.creator_article,
+        "creator_label": creator_data_.creator_label,
+        "total": creator_data_.total,
         "total_scope": len(creator),
     }
 
     return render_template("per_creator.html",
-                           creator=creator,
+                           creator=creator[:PAGE_SIZE],
+                           total=len(creator),
+                           api_url=url_for("api_works", facet="creator", value=qid),
                            qid=qid,
                            username=username,
                            creator_data=creator_data_aux,
@@ -346,13 +442,15 @@ def show_works_of_creator(qid):
 @app.route('/decades', methods=['GET'])
 @app.route('/décadas', methods=['GET'])
 def show_per_decade():
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    indefinite = "indefinite decade" if lang == "en" else "Década indeterminada"
-    json = per_decade(indefinite)
-    decades = []
-    for result in json["results"]["bindings"]:
-        decades.append({"label": result["decade"]["value"]})
+    indefinite = indefinite_decade(lang)
+    rows = per_decade(indefinite)
+    decades = None
+    if rows is not None:
+        decades = []
+        for row in rows:
+            decades.append({"label": row.decade})
     return render_template("per_decade.html", decades=decades, username=username, lang=lang, decade_data="")
 
 
@@ -360,23 +458,18 @@ def show_per_decade():
 @app.route('/decade/<decade>', methods=['GET'])
 @app.route('/década/<decade>', methods=['GET'])
 def show_works_of_decade(decade):
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    indefinite = "indefinite decade" if lang == "en" else "Década indeterminada"
-    json = works_of_decade(decade, lang, indefinite)
-    decade_ = []
-
-    for result in json["results"]["bindings"]:
-        decade_.append({
-            "qid": result["work"]["value"].split("/")[-1],
-            "label": result["work_label"]["value"],
-            "image": result["image"]["value"][51:]})
+    indefinite = indefinite_decade(lang)
+    decade_ = works_list(works_of_decade(decade, lang, indefinite))
 
     return render_template("per_decade.html",
                            decade=decade,
+                           total=len(decade_),
+                           api_url=url_for("api_works", facet="decade", value=decade),
                            indeterminate=indefinite,
                            username=username,
-                           decade_data=decade_,
+                           decade_data=decade_[:PAGE_SIZE],
                            goback="museudoipiranga",
                            lang=lang)
 
@@ -385,13 +478,15 @@ def show_works_of_decade(decade):
 @app.route('/instances', methods=['GET'])
 @app.route('/tipos', methods=['GET'])
 def show_per_instance():
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    json = per_instance(lang)
-    instances = []
-    for result in json["results"]["bindings"]:
-        instances.append({"qid": result["instance"]["value"].split("/")[-1],
-                          "label": result["instance_label"]["value"]})
+    rows = per_instance(lang)
+    instances = None
+    if rows is not None:
+        instances = []
+        for row in rows:
+            instances.append({"qid": row.instance,
+                              "label": row.instance_label})
     return render_template("per_instance.html", instances=instances, username=username, lang=lang, instance="")
 
 
@@ -399,22 +494,20 @@ def show_per_instance():
 @app.route('/instance/<qid>', methods=['GET'])
 @app.route('/tipo/<qid>', methods=['GET'])
 def show_works_of_instance(qid):
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    json = works_of_instance(qid, lang)
-    instance = []
-
-    for result in json["results"]["bindings"]:
-        instance.append({
-            "qid": result["work"]["value"].split("/")[-1],
-            "label": result["work_label"]["value"],
-            "image": result["image"]["value"][51:]})
+    results = fanout.gather({"works": (works_of_instance, qid, lang),
+                             "label": (get_name, qid)},
+                            ROUTE_DEADLINE, {"label": qid})
+    instance = works_list(results["works"])
 
-    instance_data = {"instance_label": get_name(qid),
+    instance_data = {"instance_label": results["label"],
                      "total_scope": len(instance)}
 
     return render_template("per_instance.html",
-                           instance=instance,
+                           instance=instance[:PAGE_SIZE],
+                           total=len(instance),
+                           api_url=url_for("api_works", facet="instance", value=qid),
                            qid=qid,
                            username=username,
                            instance_data=instance_data,
@@ -426,13 +519,15 @@ def show_works_of_instance(qid):
 @app.route('/depicts', methods=['GET'])
 @app.route('/descritores', methods=['GET'])
 def show_per_depict():
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    json = per_depict(lang)
-    depicts = []
-    for result in json["results"]["bindings"]:
-        depicts.append({"qid": result["depict"]["value"].split("/")[-1],
-                        "label": result["depict_label"]["value"]})
+    rows = per_depict(lang)
+    depicts = None
+    if rows is not None:
+        depicts = []
+        for row in rows:
+            depicts.append({"qid": row.depict,
+                            "label": row.depict_label})
     return render_template("per_depict.html", depicts=depicts, username=username, lang=lang, depict="")
 
 
@@ -440,22 +535,20 @@ def show_per_depict():
 @app.route('/depict/<qid>', methods=['GET'])
 @app.route('/descritor/<qid>', methods=['GET'])
 def show_works_of_depict(qid):
-    username = wikidata_oauth.get_username()
+    username = g.user
     lang = get_locale()
-    json = works_of_depict(qid)
-    depict = []
-
-    for result in json["results"]["bindings"]:
-        depict.append({
-            "qid": result["work"]["value"].split("/")[-1],
-            "label": result["work_label"]["value"],
-            "image": result["image"]["value"][51:]})
+    results = fanout.gather({"works": (works_of_depict, qid),
+                             "label": (get_name, qid, lang)},
+                            ROUTE_DEADLINE, {"label": qid})
+    depict = works_list(results["works"])
 
-    depict_data = {"depict_label": get_name(qid, lang),
+    depict_data = {"depict_label": results["label"],
                    "total_scope": len(depict)}
 
     return render_template("per_depict.html",
-                           depict=depict,
+                           depict=depict[:PAGE_SIZE],
+                           total=len(depict),
+                           api_url=url_for("api_works", facet="depict", value=qid),
                            qid=qid,
                            username=username,
                            depict_data=depict_data,
@@ -463,9 +556,57 @@ def show_works_of_depict(qid):
                            lang=lang)
 
 
+WORK_LISTS = {
+    "collection": lambda qid, lang: works_in_collection(qid),
+    "creator": lambda qid, lang: works_of_creator(qid),
+    "decade": lambda decade, lang: works_of_decade(decade, lang, indefinite_decade(lang)),
+    "instance": lambda qid, lang: works_of_instance(qid, lang),
+    "depict": lambda qid, lang: works_of_depict(qid),
+}
+
+
+@app.route('/api/<facet>/<value>', methods=['GET'])
+def api_works(facet, value):
+    if facet not in WORK_LISTS:
+        abort(404)
+    lang = get_locale()
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = min(max(request.args.get('page_size', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    works = works_list(WORK_LISTS[facet](value, lang))
+    start = (page - 1) * page_size
+    return jsonify({"total": len(works),
+                    "page": page,
+                    "page_size": page_size,
+                    "items": works[start:start + page_size]})
+
+
+SEARCH_ROUTES = {
+    "depict": "show_works_of_depict",
+    "creator": "show_works_of_creator",
+    "instance": "show_works_of_instance",
+    "collection": "show_works_in_collection",
+}
+
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    kind = request.args.get('kind')
+    if kind is not None and kind not in SEARCH_ROUTES:
+        abort(400)
+    lang = request.args.get('lang') or get_locale()
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    found = search.search(request.args.get('q', ''), lang, kind, limit)
+    return jsonify({"results": [{"qid": qid,
+                                 "label": label,
+                                 "kind": kind_,
+                                 "total": total,
+                                 "url": url_for(SEARCH_ROUTES[kind_], qid=qid)}
+                                for kind_, qid, label, total in found]})
+
+
 @app.route('/qid/<qid>/<lang>', methods=['GET'])
 def view_work_museudoipiranga(qid, lang="pt"):
-    username = wikidata_oauth.get_username()
+    username = g.user
     if "goback" in request.args:
         goback = request.args["goback"]
         if goback == "museudoipiranga":
@@ -480,45 +621,146 @@ def view_work_museudoipiranga(qid, lang="pt"):
         goback = "museudoipiranga"
         first = True
 
-    work_data_ = get_work_data(qid, lang)
-    work_depicts_ = get_p180(qid, lang)
+    results = fanout.gather({"item": (get_item, qid, lang),
+                             "next": (get_next_qid, qid)},
+                            ROUTE_DEADLINE)
+    work_data_ = results["item"]
 
     if work_data_:
+        PREFETCHER.submit(results["next"], prefetch_work, results["next"], lang,
+                          request.accept_mimetypes["image/webp"] > 0)
         return render_template("item.html",
                                entity=qid,
-                               work_depicts=work_depicts_,
+                               work_depicts=work_data_["depicts"],
                                work_data=work_data_,
                                username=username,
                                back=goback,
-                               skip=get_next_qid(qid),
+                               skip=results["next"],
                                first=first,
                                lang=lang)
     else:
         return redirect(url_for("erro", lang=lang))
 
 
+@app.route('/thumb/<int:width>/<path:filename>', methods=['GET'])
+def thumbnail(width, filename):
+    if width not in thumbnails.WIDTHS:
+        abort(404)
+    webp = request.accept_mimetypes["image/webp"] > 0
+    try:
+        path, mimetype, etag = THUMBNAILS.get(filename, width, webp)
+    except Exception:
+        app.logger.exception("Could not create the thumbnail of %s", filename)
+        return redirect(thumbnails.COMMONS_FILEPATH + quote(filename) + "?width=" + str(width) + "px")
+
+    response = send_file(path, mimetype=mimetype, etag=etag, max_age=31536000, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept")
+    return response
+
+
 @app.route('/save/<qid>/<lang>', methods=['POST'])
 def save_quantities(qid, lang):
     form = request.form
+    quantities = {}
     if form and form.__len__() > 0:
         for action in form:
+            if action == "next":
+                continue
             statement_, hash = action.split(";")
             quantity, continue_ = validate_quantity(form[action])
             if continue_:
-                if hash:
-                    try:
-                        change_qualifier(statement_, hash, quantity)
-                    except:
-                        pass
-                else:
-                    try:
-                        add_qualifier(statement_, quantity)
-                    except:
-                        pass
-    next_qid = get_next_qid(qid)
+                quantities[statement_] = quantity
+    if quantities and 'owner_key' in session:
+        EDITS.enqueue(g.user,
+                      (session['owner_key'], session['owner_secret']),
+                      qid,
+                      quantities)
+        query.forget_item(qid, [lang])
+    # The work shown next is the one prefetched while this one was shown
+    next_qid = form.get("next", "")
+    if not sparql.QID_PATTERN.fullmatch(next_qid) or next_qid == qid:
+        next_qid = get_next_qid(qid)
     return redirect(url_for("view_work_museudoipiranga", qid=next_qid, goback=qid, lang=lang))
 
 
+@app.route('/api/edits', methods=['GET'])
+def edits_status():
+    return jsonify(EDITS.status(g.user))
+
+
+PROGRESS_ROUTES = {
+    "collection": "show_works_in_collection",
+    "creator": "show_works_of_creator",
+    "depict": "show_works_of_depict",
+}
+
+
+@app.route('/api/progress', methods=['GET'])
+def api_progress():
+    lang = request.args.get('lang') or get_locale()
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 1000)
+    return jsonify(progress_data(lang, limit))
+
+
+@app.route('/progress', methods=['GET'])
+@app.route('/progresso', methods=['GET'])
+def show_progress():
+    username = g.user
+    lang = get_locale()
+    return render_template("progress.html", progress=progress_data(lang, 20), username=username, lang=lang)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_export():
+    gauges = [("povoconta_cache_" + key, "Response cache: " + key.replace("_", " "), {}, value)
+              for key, value in query.CACHE.stats().items()]
+    gauges.append(("povoconta_deck_cards", "Works left in the deck", {}, len(query.DECK.cards)))
+    gauges.append(("povoconta_catalog_loaded", "Whether the catalog is loaded", {}, int(catalog.is_loaded())))
+    snapshot = query.VIEWS.snapshot
+    if snapshot is not None:
+        gauges.append(("povoconta_views_version", "Version of the snapshot of the facet views", {}, snapshot.version))
+        gauges.append(("povoconta_views_built", "Unix time the snapshot of the facet views was built", {},
+                       snapshot.built))
+    return Response(metrics.REGISTRY.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+def prefetch_work(qid, lang, webp):
+    # Warms the caches with what the item page of qid needs
+    work_data_ = get_item(qid, lang)
+    if work_data_:
+        THUMBNAILS.get(unquote(work_data_["image"]), 2000, webp)
+
+
+def progress_data(lang, limit):
+    data = {"updated": PROGRESS.updated, "total": progress_counter(PROGRESS.total())}
+    for kind, endpoint in PROGRESS_ROUTES.items():
+        data[kind + "s"] = [dict(progress_counter(counter), qid=qid, label=labels.label(qid, lang),
+                                 url=url_for(endpoint, qid=qid))
+                            for qid, counter in PROGRESS.breakdown(kind, limit)]
+    return data
+
+
+def progress_counter(counter):
+    statements, counted, works, complete = counter
+    return {"statements": statements, "counted": counted, "works": works, "complete_works": complete}
+
+
+def indefinite_decade(lang):
+    return "indefinite decade" if lang == "en" else "Década indeterminada"
+
+
+def works_list(rows):
+    works = []
+    for row in rows:
+        works.append({
+            "qid": row.work,
+            "label": row.work_label,
+            "image": row.image})
+    return works
+
+
 def validate_quantity(quantity):
     if quantity == "" or quantity == "0":
         return "", False
@@ -529,152 +771,54 @@ def validate_quantity(quantity):
             return "", False
 
 
-def get_work_depicts(qid, lang):
-    depicts_work = work_depicts(qid, lang, "pt-br")
-    work_depicts_ = []
-    for result in depicts_work["results"]["bindings"]:
-        depicts_id = result["depicts_"]["value"].split("/")[-1]
-        depicts_qid = result["depicts"]["value"].split("/")[-1]
-        if "depicts_label_ptbr" in result:
-            depicts_label = result["depicts_label_ptbr"]["value"]
-        elif "depicts_label_pt" in result:
-            depicts_label = result["depicts_label_pt"]["value"]
-        else:
-            depicts_label = ""
-        if "depicts_desc_ptbr" in result:
-            depicts_desc = result["depicts_desc_ptbr"]["value"]
-        elif "depicts_desc_pt" in result:
-            depicts_desc = result["depicts_desc_pt"]["value"]
-        else:
-            depicts_desc = ""
-        quantity_hash = result["quantity_"]["value"] if "quantity_" in result else ""
-        quantity_value = result["quantity"]["value"] if "quantity" in result else 0
-
-        work_depicts_.append({"depict_id": depicts_id,
-                              "depict_qid": depicts_qid,
-                              "depict_label": depicts_label,
-                              "depict_desc": depicts_desc,
-                              "quantity_hash": quantity_hash,
-                              "quantity_value": quantity_value})
-    return work_depicts_
-
-
-def get_work_data(qid, lang):
-    data_work = work_data(qid, lang, "pt-br")
-    if data_work["results"]["bindings"].__len__()>0:
-        if "work_label_" in data_work["results"]["bindings"][0]:
-            work_label = data_work["results"]["bindings"][0]["work_label_"]["value"]
-        else:
-            work_label = ""
-        if "image" in data_work["results"]["bindings"][0]:
-            image = data_work["results"]["bindings"][0]["image"]["value"][51:]
-        else:
-            image = ""
-        if "date" in data_work["results"]["bindings"][0]:
-            date_aux = data_work["results"]["bindings"][0]["date"]["value"]
-            if date_aux.startswith("Século"):
-                date = "Século "+str(roman.toRoman(ceil(int(date_aux.replace("Século ", ""))/100)))
-            else:
-                date = date_aux
-        else:
-            date = ""
-        if "instances" in data_work["results"]["bindings"][0]:
-            instances_ = data_work["results"]["bindings"][0]["instances"]["value"].split(";")
-        else:
-            instances_ = []
-        if "instance_labels" in data_work["results"]["bindings"][0]:
-            instance_labels_ = data_work["results"]["bindings"][0]["instance_labels"]["value"].split(";")
-        else:
-            instance_labels_ = []
-        if "creators" in data_work["results"]["bindings"][0]:
-            creators_ = data_work["results"]["bindings"][0]["creators"]["value"].split(";")
-        else:
-            creators_ = []
-        if "creators_labels" in data_work["results"]["bindings"][0]:
-            creators_labels_ = data_work["results"]["bindings"][0]["creators_labels"]["value"].split(";")
-        else:
-            creators_labels_ = []
-        if "materials" in data_work["results"]["bindings"][0]:
-            materials_ = data_work["results"]["bindings"][0]["materials"]["value"].split(";")
-        else:
-            materials_ = []
-        if "materials_labels" in data_work["results"]["bindings"][0]:
-            materials_labels_ = data_work["results"]["bindings"][0]["materials_labels"]["value"].split(";")
-        else:
-            materials_labels_ = []
-        if "commissioners" in data_work["results"]["bindings"][0]:
-            commissioners_ = data_work["results"]["bindings"][0]["commissioners"]["value"].split(";")
-        else:
-            commissioners_ = []
-        if "commissioners_labels" in data_work["results"]["bindings"][0]:
-            commissioners_labels_ = data_work["results"]["bindings"][0]["commissioners_labels"]["value"].split(";")
-        else:
-            commissioners_labels_ = []
-
-        instances = []
-        if instances_ and instance_labels_ and len(instances_)==len(instance_labels_) and instances!=[""]:
-            for i in range(len(instances_)):
-                instances.append({"qid": instances_[i].split("/")[-1],
-                                  "label": instance_labels_[i]})
-        creators = []
-        if creators_ and creators_labels_ and len(creators_) == len(creators_labels_) and creators_!=[""]:
-            for i in range(len(creators_)):
-                creators.append({"qid": creators_[i].split("/")[-1],
-                                  "label": creators_labels_[i]})
-        materials = []
-        if materials_ and materials_labels_ and len(materials_) == len(materials_labels_) and materials_!=[""]:
-            for i in range(len(materials_)):
-                materials.append({"qid": materials_[i].split("/")[-1],
-                                  "label": materials_labels_[i]})
-        commissioners = []
-        if commissioners_ and commissioners_labels_ and len(commissioners_) == len(commissioners_labels_) and commissioners_!=[""]:
-            for i in range(len(commissioners_)):
-                commissioners.append({"qid": commissioners_[i].split("/")[-1],
-                                      "label": commissioners_labels_[i]})
-
-        work_data_ = {"work_label": work_label,
-                      "image": image,
-                      "date": date,
-                      "instances": instances,
-                      "creators": creators,
-                      "materials": materials,
-                      "commissioners": commissioners}
-
-        return work_data_
-    else:
-        return ""
-
-
 ############################################################################
 # REQUESTS TO WIKIDATA                                                     #
 ############################################################################
-def add_qualifier(claim, quantity):
-    token = wikidata_oauth.get_token()
+def set_quantities(qid, quantities, credentials=None):
+    # All the P1114 qualifiers of the work are saved in a single revision:
+    # one call for the token, one for the current statements, one for the edit
+    token = wikidata_oauth.get_token(credentials)
     params = {
-        "action": "wbsetqualifier",
-        "claim": claim,
-        "property": "P1114",
-        "value": "{\"amount\":\"+"+str(quantity)+"\", \"unit\": \"1\"}",
-        "snaktype": "value",
-        "token": token
+        "action": "wbgetentities",
+        "ids": qid,
+        "props": "claims|info",
+        "format": "json"
     }
+    entity = wikidata_oauth.api_request(params, credentials)["entities"][qid]
+
+    claims = []
+    for statement in entity.get("claims", {}).get("P180", []):
+        if statement["id"] not in quantities:
+            continue
+        quantity = quantities[statement["id"]]
+        qualifiers = statement.setdefault("qualifiers", {})
+        current = qualifiers.get("P1114", [])
+        if len(current) == 1 and current[0].get("datavalue", {}).get("value", {}).get("amount") == "+" + str(quantity):
+            continue
+        qualifiers["P1114"] = [{
+            "snaktype": "value",
+            "property": "P1114",
+            "datavalue": {"value": {"amount": "+" + str(quantity), "unit": "1"}, "type": "quantity"}
+        }]
+        order = statement.setdefault("qualifiers-order", [])
+        if "P1114" not in order:
+            order.append("P1114")
+        claims.append(statement)
+
+    if not claims:
+        return None
 
-    wikidata_oauth.api_post_request(params)
-
-
-def change_qualifier(claim, hash, quantity):
-    token = wikidata_oauth.get_token()
     params = {
-        "action": "wbsetqualifier",
-        "claim": claim,
-        "property": "P1114",
-        "value": "{\"amount\": \"+" + str(quantity) + "\", \"unit\": \"1\"}",
-        "snaktype": "value",
-        "snakhash": hash,
-        "token": token
+        "action": "wbeditentity",
+        "id": qid,
+        "data": json.dumps({"claims": claims}),
+        "baserevid": entity["lastrevid"],
+        "maxlag": 5,
+        "token": token,
+        "format": "json"
     }
 
-    wikidata_oauth.api_post_request(params)
+    return wikidata_oauth.api_post_request(params, credentials)
 
 
 def remove_qualifier(claim, qualifier):
@@ -689,6 +833,23 @@ def remove_qualifier(claim, qualifier):
     wikidata_oauth.api_post_request(params)
 
 
+############################################################################
+# FACET VIEWS                                                              #
+############################################################################
+def define_views(languages):
+    for name in ("per_collection", "per_creator", "per_instance", "per_depict"):
+        query.VIEWS.define(name, getattr(query, "build_" + name), languages)
+    query.VIEWS.define("per_decade", query.build_per_decade, [indefinite_decade(lang) for lang in languages])
+    query.VIEWS.define("total_works", query.build_total_works)
+
+
+define_views(app.config['LANGUAGES'])
+catalog.CALLBACKS.append(lambda catalog_: query.VIEWS.invalidate())
+catalog.CALLBACKS.append(search.rebuild)
+catalog.CALLBACKS.append(PROGRESS.load)
+query.VIEWS.start(app.config.get('VIEWS_REFRESH_INTERVAL', 600))
+
+
 ############################################################################
 # RUN THE APP                                                              #
 ############################################################################
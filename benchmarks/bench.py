@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Offline benchmarks of the routes of the application and of the function
+# that builds the item page. The Wikidata Query Service and the Wikidata API
+# are replaced by a local server that replays responses recorded in
+# benchmarks/fixtures, so the numbers only depend on the code.
+#
+#   python benchmarks/bench.py record                 # record the fixtures (needs network)
+#   python benchmarks/bench.py run -o head.json       # run the benchmarks offline
+#   python benchmarks/bench.py compare base.json head.json
+#
+# The runs compared must replay the same recorded snapshot: compare fails if a
+# fixture that both runs used was recorded again between them.
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+UPSTREAMS = {
+    "/sparql": "https://query.wikidata.org/sparql",
+    "/w/api.php": "https://www.wikidata.org/w/api.php",
+}
+# Parameters that do not change the response
+VOLATILE = ("maxAge", "_")
+SAMPLE_QID = "Q56730380"
+SAMPLE_COLLECTION = "Q56677463"
+
+
+def fixture_key(path, params, accept):
+    params = sorted((key, " ".join(value.split()) if key == "query" else value)
+                    for key, value in params if key not in VOLATILE)
+    return hashlib.sha1((path + "?" + urlencode(params) + " " + accept).encode("utf-8")).hexdigest()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.reply(parse_qsl(urlsplit(self.path).query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        self.reply(parse_qsl(urlsplit(self.path).query) + parse_qsl(body))
+
+    def reply(self, params):
+        server = self.server
+        path = urlsplit(self.path).path
+        # The Query Service is asked for CSV, the API answers in JSON
+        accept = self.headers.get("Accept", "*/*") if path == "/sparql" else "*/*"
+        key = fixture_key(path, params, accept)
+        fixture_path = os.path.join(FIXTURES, key + ".json")
+
+        if server.record and not os.path.exists(fixture_path) and path in UPSTREAMS:
+            response = requests.post(UPSTREAMS[path], data=dict(params), timeout=60,
+                                      headers={"User-agent": "Wiki Museu do Ipiranga - Quantos tem? benchmarks",
+                                               "Accept": accept})
+            with open(fixture_path, "w", encoding="utf-8") as file:
+                json.dump({"path": path, "params": sorted(params), "status": response.status_code,
+                           "content_type": response.headers.get("Content-Type", "application/json"),
+                           "body": response.text}, file, ensure_ascii=False, indent=1)
+
+        if os.path.exists(fixture_path):
+            with open(fixture_path, encoding="utf-8") as file:
+                fixture = json.load(file)
+            status, content_type, body = fixture["status"], fixture["content_type"], fixture["body"].encode("utf-8")
+            with server.lock:
+                server.served[key] = hashlib.sha1(body).hexdigest()
+        else:
+            status, content_type, body = 404, "application/json", b"{}"
+            with server.lock:
+                server.missing.append((path, params))
+
+        with server.lock:
+            server.calls += 1
+            server.bytes += len(body)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(record):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.daemon_threads = True
+    server.record = record
+    server.lock = threading.Lock()
+    server.calls = 0
+    server.bytes = 0
+    server.missing = []
+    # Fixture key -> hash of the body replayed, to tell whether two runs used the same recording
+    server.served = {}
+    threading.Thread(target=server.serve_forever, name="stand-in", daemon=True).start()
+    return server
+
+
+def load_app(server):
+    sys.path.insert(0, ROOT)
+    import catalog
+    import query
+    base = "http://127.0.0.1:%d" % server.server_address[1]
+    query.SPARQL_ENDPOINT = base + "/sparql"
+    query.WIKIDATA_API_ENDPOINT = base + "/w/api.php"
+    # The catalog is loaded on demand by the benchmarks, not by a thread
+    catalog.start = lambda *args, **kwargs: None
+    import app
+    import throttle
+    app.PREFETCHER.submit = lambda *args, **kwargs: False
+    # The stand-in has no rate limit, only the cost of the limiter is measured
+    throttle.configure({"WDQS_LIMITER_PATH": os.path.join(ROOT, "benchmarks", "wdqs.limiter"),
+                        "WDQS_MAX_CONCURRENT": 1000, "WDQS_PER_MINUTE": 10 ** 9, "WDQS_BURST": 10 ** 9})
+    # The facet pages only read the snapshot of the views
+    query.VIEWS.refresh()
+    return app
+
+
+def cases(app, qid, collection):
+    import query
+    client = app.app.test_client()
+    headers = {"Accept-Language": "pt"}
+
+    def route(url):
+        return url, lambda: client.get(url, headers=headers)
+
+    return [
+        route("/"),
+        route("/sobre"),
+        route("/tutorial"),
+        route("/p195"),
+        route("/p195/" + collection),
+        route("/p170"),
+        route("/p571"),
+        route("/p571/1890"),
+        route("/p31"),
+        route("/p180"),
+        route("/api/collection/" + collection + "?page=2"),
+        route("/qid/" + qid + "/pt"),
+        ("get_item", lambda: query.get_item(qid, "pt")),
+    ]
+
+
+def reset(app, warm):
+    import query
+    random.seed(0)
+    if not warm:
+        query.CACHE.invalidate()
+        query.DECK.cards = []
+
+
+def measure(app, server, func, repeat, warm):
+    walls, cpus = [], []
+    if warm:
+        func()
+    for i in range(repeat):
+        reset(app, warm)
+        with server.lock:
+            server.calls, server.bytes, server.missing = 0, 0, []
+        wall, cpu = time.perf_counter(), time.process_time()
+        func()
+        walls.append((time.perf_counter() - wall) * 1000)
+        cpus.append((time.process_time() - cpu) * 1000)
+    calls, bytes_, missing = server.calls, server.bytes, len(server.missing)
+
+    # Allocations are measured in a separate run, tracemalloc slows everything down
+    reset(app, warm)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    func()
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+
+    return {"wall_ms": round(statistics.median(walls), 3),
+            "cpu_ms": round(statistics.median(cpus), 3),
+            "alloc_peak_kib": round(peak / 1024, 1),
+            "alloc_blocks": blocks,
+            "upstream_calls": calls,
+            "upstream_bytes": bytes_,
+            "missing_fixtures": missing}
+
+
+def run(args):
+    recording = args.command == "record"
+    if not recording and not any(name.endswith(".json") for name in os.listdir(FIXTURES)):
+        print("No fixtures in %s, record them first with: python benchmarks/bench.py record" % FIXTURES,
+              file=sys.stderr)
+        return 2
+    server = start_stand_in(recording)
+    app = load_app(server)
+    if args.catalog:
+        import catalog
+        catalog.refresh()
+    repeat = 1 if args.command == "record" else args.repeat
+    results = {}
+    failed, missing = [], []
+    for name, func in cases(app, args.qid, args.collection):
+        try:
+            results[name] = measure(app, server, func, repeat, args.warm)
+        except Exception as e:
+            # Usually a fixture that was not recorded
+            print("%-40s failed: %r" % (name, e))
+            failed.append(name)
+            continue
+        if results[name]["missing_fixtures"]:
+            failed.append(name)
+            missing.extend(server.missing)
+        print("%-40s %10.1f ms wall %10.1f ms cpu %8d KiB %4d calls %s" % (
+            name, results[name]["wall_ms"], results[name]["cpu_ms"], results[name]["alloc_peak_kib"],
+            results[name]["upstream_calls"],
+            "(%d missing fixtures)" % results[name]["missing_fixtures"] if results[name]["missing_fixtures"] else ""))
+    server.shutdown()
+    if failed and not recording:
+        # Timings measured against the 404s of missing fixtures mean nothing
+        print("\n%d cases failed or miss fixtures, record them with: python benchmarks/bench.py record" % len(failed),
+              file=sys.stderr)
+        for path, params in missing[:10]:
+            print("  missing %s %s" % (path, dict(params)), file=sys.stderr)
+        return 1
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"catalog": args.catalog, "warm": args.warm, "fixtures": server.served, "results": results},
+                      file, indent=1)
+    return 0
+
+
+def compare(args):
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.head) as file:
+        head = json.load(file)
+    # Queries that changed between the commits have fixtures of their own, but the ones
+    # both runs replayed must be the same, or the live data changed between the recordings
+    rerecorded = [key for key in set(base.get("fixtures", {})) & set(head.get("fixtures", {}))
+                  if base["fixtures"][key] != head["fixtures"][key]]
+    if rerecorded:
+        print("%d fixtures were recorded again between the runs, run both against the same snapshot" %
+              len(rerecorded), file=sys.stderr)
+        return 1
+    base, head = base["results"], head["results"]
+    regressions = 0
+    for name in head:
+        if base.get(name, {}).get("missing_fixtures") or head[name].get("missing_fixtures"):
+            print("%-40s measured with missing fixtures" % name)
+            regressions += 1
+            continue
+        if name not in base:
+            continue
+        for metric in ("wall_ms", "cpu_ms", "alloc_peak_kib", "upstream_calls"):
+            before, after = base[name][metric], head[name][metric]
+            threshold = 0 if metric == "upstream_calls" else args.threshold
+            regressed = after > before * (1 + threshold) and after - before > args.noise.get(metric, 0)
+            regressions += regressed
+            change = (after - before) / before * 100 if before else 0
+            print("%-40s %-16s %12s %12s %+8.1f%% %s" % (name, metric, before, after, change,
+                                                       "REGRESSION" if regressed else ""))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command in ("run", "record"):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument("-o", "--output")
+        subparser.add_argument("-n", "--repeat", type=int, default=5)
+        subparser.add_argument("--qid", default=SAMPLE_QID)
+        subparser.add_argument("--collection", default=SAMPLE_COLLECTION)
+        subparser.add_argument("--catalog", action="store_true", help="serve the pages from the loaded catalog")
+        subparser.add_argument("--warm", action="store_true", help="keep the response cache between runs")
+    subparser = subparsers.add_parser("compare")
+    subparser.add_argument("base")
+    subparser.add_argument("head")
+    subparser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+    # Absolute differences below these are noise
+    args.noise = {"wall_ms": 1, "cpu_ms": 1, "alloc_peak_kib": 16}
+
+    if args.command == "compare":
+        sys.exit(compare(args))
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Bounded in-memory cache for the responses of the upstream services. Each
+# entry lives for the TTL of its query family; once expired, the stale value
+# keeps being served while a single background thread fetches a fresh one.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+
+def normalize(text):
+    return " ".join(text.split())
+
+
+class ResponseCache(object):
+    def __init__(self, maxsize=512, max_stale=86400):
+        self.maxsize = maxsize
+        self.max_stale = max_stale
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def get(self, key, ttl, loader):
+        if ttl <= 0:
+            return loader()
+
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = now - stored_at
+                if age < ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if age < ttl + self.max_stale:
+                    self.entries.move_to_end(key)
+                    self.stale_hits += 1
+                    if key not in self.refreshing:
+                        self.refreshing.add(key)
+                        threading.Thread(target=self._refresh, args=(key, loader),
+                                         name="cache-refresh", daemon=True).start()
+                    return value
+            self.misses += 1
+
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def _refresh(self, key, loader):
+        try:
+            value = loader()
+        except Exception:
+            LOGGER.exception("Could not refresh a cached response, serving the stale one")
+            with self.lock:
+                self.refresh_errors += 1
+        else:
+            self.set(key, value)
+            with self.lock:
+                self.refreshes += 1
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries),
+                    "maxsize": self.maxsize,
+                    "hits": self.hits,
+                    "stale_hits": self.stale_hits,
+                    "misses": self.misses,
+                    "refreshes": self.refreshes,
+                    "refresh_errors": self.refresh_errors}
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Local snapshot of the works of the Museu Paulista collection (Q56677470)
+# that have an image (P18) and at least one descriptor (P180). The whole
+# set is bulk loaded from the Wikidata Query Service and kept in memory,
+# so the listing pages can be answered without a round trip to WDQS.
+
+import logging
+import threading
+import time
+from math import floor
+from urllib.parse import quote
+
+import labels as label_store
+import query
+import results
+
+ROOT_COLLECTION = "Q56677470"
+LANGUAGES = label_store.LANGUAGES
+STATEMENT_PREFIX = results.ENTITY_PREFIX + "statement/"
+EXCLUDED_INSTANCE = "Q18593264"
+SCOPE = "?work wdt:P195 wd:" + ROOT_COLLECTION + "; wdt:P18 []; wdt:P180 []. "
+WORK_PROPERTIES = {"P195": "collections", "P170": "creators", "P31": "instances",
+                   "P186": "materials", "P88": "commissioners"}
+PARENT_PROPERTIES = ("P170", "P31", "P180")
+
+LOGGER = logging.getLogger(__name__)
+_CATALOG = None
+# Called with the new catalog every time it is replaced
+CALLBACKS = []
+
+
+class Work(object):
+    __slots__ = ("qid", "image", "revision", "collections", "creators", "instances", "materials",
+                 "commissioners", "dates", "depicts")
+
+    def __init__(self, qid, image, revision=0):
+        self.qid = qid
+        self.image = image
+        self.revision = revision
+        self.collections = ()
+        self.creators = ()
+        self.instances = ()
+        self.materials = ()
+        self.commissioners = ()
+        # (year, precision) of every P571 value
+        self.dates = ()
+        # (statement id, depicted qid, P1114 amount or None) of every P180 statement
+        self.depicts = ()
+
+    def decades(self, indeterminate):
+        decades = set()
+        for year, precision in self.dates:
+            if precision == 7:
+                decades.add(indeterminate)
+            else:
+                decades.add(str(10 * floor(year / 10)))
+        return decades
+
+    def counted(self):
+        return sum(1 for statement in self.depicts if statement[2] is not None)
+
+    def uncounted(self):
+        return any(statement[2] is None for statement in self.depicts)
+
+
+class Catalog(object):
+    def __init__(self, works, parents, labels, descriptions):
+        self.works = works
+        self.parents = parents
+        self.labels = labels
+        self.descriptions = descriptions
+        self.loaded_at = time.time()
+        self.index()
+
+    def index(self):
+        self.by_collection = {}
+        self.by_creator = {}
+        self.by_instance = {}
+        self.by_depict = {}
+        self.instances_direct = {}
+        self.depicts_direct = {}
+        for work in self.works.values():
+            for collection in work.collections:
+                self.by_collection.setdefault(collection, []).append(work)
+            for attribute, index, direct, prop in (("creators", self.by_creator, None, "P170"),
+                                                   ("instances", self.by_instance, self.instances_direct, "P31"),
+                                                   (None, self.by_depict, self.depicts_direct, "P180")):
+                if attribute:
+                    values = set(getattr(work, attribute))
+                else:
+                    values = set(statement[1] for statement in work.depicts)
+                if direct is not None:
+                    for value in values:
+                        direct.setdefault(value, []).append(work)
+                for value in self.inherited(work, values, prop):
+                    index.setdefault(value, []).append(work)
+
+    def inherited(self, work, values, prop):
+        # The values of a work, with those its collections give to all their works
+        values = set(values)
+        for collection in work.collections:
+            values.update(self.parents.get(collection, {}).get(prop, ()))
+        return values
+
+    def label(self, qid, lang):
+        return self.labels.get(qid, {}).get(lang)
+
+    def label_fallback(self, qid):
+        labels = self.labels.get(qid, {})
+        for lang in LANGUAGES:
+            if lang in labels:
+                return labels[lang]
+        return qid
+
+
+def get():
+    return _CATALOG
+
+
+def is_loaded():
+    return _CATALOG is not None
+
+
+def _rows(sparql):
+    # The bulk queries are decoded as they are downloaded, and not cached
+    return query.stream_wikidata(sparql, family="catalog")
+
+
+def load():
+    works = {}
+    for row in _rows("SELECT ?work (SAMPLE(?image) AS ?image) (MAX(?version) AS ?revision) WHERE {"
+                     "?work wdt:P195 wd:" + ROOT_COLLECTION + "; wdt:P18 ?image; schema:version ?version. "
+                     "FILTER EXISTS {?work wdt:P180 []}} GROUP BY ?work"):
+        works[row.work] = Work(row.work, row.image, int(row.revision))
+
+    for prop, attribute in WORK_PROPERTIES.items():
+        values = {}
+        for row in _rows("SELECT DISTINCT ?work ?value WHERE {" + SCOPE +
+                         "?work wdt:" + prop + " ?value. FILTER(isIRI(?value))}"):
+            values.setdefault(row.work, []).append(row.value)
+        for qid, values_ in values.items():
+            if qid in works:
+                setattr(works[qid], attribute, tuple(values_))
+
+    dates = {}
+    for row in _rows("SELECT DISTINCT ?work ?time ?precision WHERE {" + SCOPE +
+                     "?work p:P571/psv:P571 ?date. "
+                     "?date wikibase:timeValue ?time; wikibase:timePrecision ?precision.}"):
+        year = int(row.time[:row.time.index("-", 1)])
+        dates.setdefault(row.work, []).append((year, int(row.precision)))
+    for qid, dates_ in dates.items():
+        if qid in works:
+            works[qid].dates = tuple(dates_)
+
+    depicts = {}
+    for row in _rows("SELECT DISTINCT ?work ?statement ?value ?quantity WHERE {" + SCOPE +
+                     "?work p:P180 ?statement. ?statement ps:P180 ?value. "
+                     "OPTIONAL {?statement pq:P1114 ?quantity.} FILTER(isIRI(?value))}"):
+        statement = row.statement[len(STATEMENT_PREFIX):].replace("-", "$", 1)
+        quantity = int(float(row.quantity)) if row.quantity else None
+        depicts.setdefault(row.work, []).append((statement, row.value, quantity))
+    for qid, depicts_ in depicts.items():
+        if qid in works:
+            works[qid].depicts = tuple(depicts_)
+
+    parents = {}
+    for row in _rows("SELECT DISTINCT ?item ?prop ?value WHERE {" + SCOPE +
+                     "?work wdt:P195 ?item. ?item ?prop ?value. "
+                     "VALUES ?prop {" + " ".join("wdt:" + prop for prop in PARENT_PROPERTIES) + "} "
+                     "FILTER(isIRI(?value))}"):
+        parents.setdefault(row.item, {}).setdefault(row.prop.split("/")[-1], set()).add(row.value)
+
+    labels = {}
+    descriptions = {}
+    for row in _rows("SELECT DISTINCT ?item ?property ?text (LANG(?text) AS ?lang) WHERE {" + SCOPE +
+                     "{BIND(?work AS ?item)} "
+                     "UNION {?work wdt:P195|wdt:P170|wdt:P31|wdt:P180|wdt:P186|wdt:P88 ?item.} "
+                     "UNION {?work wdt:P195/(wdt:P170|wdt:P31|wdt:P180) ?item.} "
+                     "?item ?property ?text. VALUES ?property {rdfs:label schema:description} "
+                     "FILTER(LANG(?text) IN (" + ",".join("'" + lang + "'" for lang in LANGUAGES) + "))}"):
+        values = labels if row.property.endswith("#label") else descriptions
+        values.setdefault(row.item, {})[row.lang] = row.text
+
+    return Catalog(works, parents, labels, descriptions)
+
+
+def refresh():
+    global _CATALOG
+    started = time.time()
+    catalog = load()
+    _CATALOG = catalog
+    label_store.STORE.replace(catalog.labels, catalog.descriptions)
+    LOGGER.info("Catalog loaded with %d works in %.1fs", len(catalog.works), time.time() - started)
+    _notify(catalog)
+    return catalog
+
+
+def _notify(catalog):
+    for callback in CALLBACKS:
+        try:
+            callback(catalog)
+        except Exception:
+            LOGGER.exception("Catalog callback failed")
+
+
+############################################################################
+# INCREMENTAL SYNC                                                         #
+############################################################################
+def _api_entities(ids, props, languages=LANGUAGES):
+    entities = {}
+    ids = list(ids)
+    for i in range(0, len(ids), query.WBGETENTITIES_LIMIT):
+        params = {
+            "action": "wbgetentities",
+            "ids": "|".join(ids[i:i + query.WBGETENTITIES_LIMIT]),
+            "props": props,
+            "languages": "|".join(languages),
+            "format": "json"
+        }
+        entities.update(query.wbgetentities(params, "catalog_sync").get("entities", {}))
+    return entities
+
+
+def claim_values(claims, prop):
+    values = []
+    for claim in claims.get(prop, []):
+        if claim["mainsnak"].get("snaktype") == "value" and claim.get("rank") != "deprecated":
+            values.append(claim["mainsnak"]["datavalue"]["value"])
+    return values
+
+
+def claim_ids(claims, prop):
+    return tuple(dict.fromkeys(value["id"] for value in claim_values(claims, prop)
+                               if isinstance(value, dict) and "id" in value))
+
+
+def work_from_entity(entity):
+    # Builds the Work of an entity document, or returns None if it is out of scope
+    claims = entity.get("claims", {})
+    images = claim_values(claims, "P18")
+    collections = claim_ids(claims, "P195")
+    if not images or ROOT_COLLECTION not in collections or not claim_values(claims, "P180"):
+        return None
+
+    work = Work(entity["id"], quote(images[0]), entity.get("lastrevid", 0))
+    work.collections = collections
+    for prop, attribute in WORK_PROPERTIES.items():
+        if prop != "P195":
+            setattr(work, attribute, claim_ids(claims, prop))
+    work.dates = tuple((int(value["time"][:value["time"].index("-", 1)]), value["precision"])
+                       for value in claim_values(claims, "P571"))
+    depicts = []
+    for claim in claims.get("P180", []):
+        if claim["mainsnak"].get("snaktype") != "value":
+            continue
+        quantity = None
+        for qualifier in claim.get("qualifiers", {}).get("P1114", []):
+            if qualifier.get("snaktype") == "value":
+                quantity = int(float(qualifier["datavalue"]["value"]["amount"]))
+                break
+        depicts.append((claim["id"], claim["mainsnak"]["datavalue"]["value"]["id"], quantity))
+    work.depicts = tuple(depicts)
+    return work
+
+
+def sync():
+    # Re-fetches only the works whose revision changed since they were
+    # loaded, the works that entered the collection and the labels of the
+    # entities they reference for the first time
+    global _CATALOG
+    catalog = _CATALOG
+    if catalog is None:
+        return refresh()
+    started = time.time()
+
+    revisions = _api_entities(catalog.works, "info")
+    # Works absent from the reply are left as they are
+    changed = set(qid for qid, work in catalog.works.items()
+                  if qid in revisions and revisions[qid].get("lastrevid") != work.revision)
+    for row in _rows("SELECT DISTINCT ?work WHERE {" + SCOPE + "}"):
+        if row.work not in catalog.works:
+            changed.add(row.work)
+    if not changed:
+        return catalog
+
+    works = dict(catalog.works)
+    labels = dict(catalog.labels)
+    descriptions = dict(catalog.descriptions)
+    parents = dict(catalog.parents)
+    entities = _api_entities(changed, "info|claims|labels|descriptions")
+    for qid in changed:
+        if qid not in entities:
+            continue
+        entity = entities[qid]
+        # A work is only dropped when it was deleted or left the scope
+        work = work_from_entity(entity) if "missing" not in entity else None
+        if work is None:
+            works.pop(qid, None)
+        else:
+            works[qid] = work
+            labels[qid] = label_store.entity_values(entity, "labels")
+            descriptions[qid] = label_store.entity_values(entity, "descriptions")
+
+    referenced = set()
+    new_collections = set()
+    for qid in changed:
+        if qid in works:
+            work = works[qid]
+            referenced.update(work.collections + work.creators + work.instances + work.materials +
+                              work.commissioners + tuple(statement[1] for statement in work.depicts))
+            new_collections.update(collection for collection in work.collections if collection not in parents)
+    for qid, entity in _api_entities(new_collections, "claims").items():
+        claims = entity.get("claims", {})
+        parents[qid] = {prop: set(claim_ids(claims, prop)) for prop in PARENT_PROPERTIES}
+        referenced.update(*parents[qid].values())
+    for qid, entity in _api_entities(referenced.difference(labels), "labels|descriptions").items():
+        labels[qid] = label_store.entity_values(entity, "labels")
+        descriptions[qid] = label_store.entity_values(entity, "descriptions")
+
+    _CATALOG = Catalog(works, parents, labels, descriptions)
+    label_store.STORE.replace(_CATALOG.labels, _CATALOG.descriptions)
+    LOGGER.info("Catalog synced %d changed works in %.1fs", len(changed), time.time() - started)
+    _notify(_CATALOG)
+    return _CATALOG
+
+
+def start(interval=21600, sync_interval=600):
+    def run():
+        loaded_at = 0
+        while True:
+            try:
+                if time.time() - loaded_at >= interval:
+                    refresh()
+                    loaded_at = time.time()
+                else:
+                    sync()
+            except Exception:
+                LOGGER.exception("Could not load the catalog, the live queries will be used")
+            time.sleep(min(interval, sync_interval))
+
+    thread = threading.Thread(target=run, name="catalog", daemon=True)
+    thread.start()
+    return thread
+
+
+############################################################################
+# FACETS                                                                   #
+############################################################################
+WORK_ROW = results.row_type(("work", "image", "work_label"))
+
+
+def _work_rows(catalog, works, lang=None, key=None):
+    rows = []
+    for work in works:
+        if lang is None:
+            label = catalog.label_fallback(work.qid)
+        else:
+            label = catalog.label(work.qid, lang)
+            if label is None:
+                continue
+        rows.append((key(work), WORK_ROW(work.qid, work.image, label)))
+    rows.sort(key=lambda row: row[0])
+    return [row for _, row in rows]
+
+
+def _facet_rows(catalog, index, lang, key, label_key, total_key, exclude=()):
+    row_type = results.row_type((key, label_key, total_key))
+    rows = []
+    for qid, works in index.items():
+        label = catalog.label(qid, lang)
+        if label is None or qid in exclude:
+            continue
+        rows.append(row_type(qid, label, str(len(works))))
+    rows.sort(key=lambda row: int(row[2]))
+    return rows
+
+
+def _depict_count(work):
+    return len(work.depicts)
+
+
+def per_collection(lang):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    return _facet_rows(catalog, catalog.by_collection, lang,
+                       "collection", "collection_label", "num_works", exclude=(ROOT_COLLECTION,))
+
+
+def works_in_collection(qid_collection):
+    catalog = _CATALOG
+    if catalog is None or qid_collection not in catalog.by_collection:
+        return None
+    return _work_rows(catalog, catalog.by_collection[qid_collection], key=Work.counted)
+
+
+def total_works():
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    return len(catalog.works)
+
+
+def per_creator(lang):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    return _facet_rows(catalog, catalog.by_creator, lang, "creator", "creator_label", "total")
+
+
+def works_of_creator(qid_creator, lang):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    return _work_rows(catalog, catalog.by_creator.get(qid_creator, ()), lang, _depict_count)
+
+
+def per_decade(indeterminate):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    decades = set()
+    for work in catalog.works.values():
+        decades.update(work.decades(indeterminate))
+    row_type = results.row_type(("decade",))
+    return [row_type(decade) for decade in sorted(decades)]
+
+
+def works_of_decade(decade, lang, indeterminate):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    works = [work for work in catalog.works.values() if decade in work.decades(indeterminate)]
+    return _work_rows(catalog, works, lang, _depict_count)
+
+
+def per_instance(lang):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    return _facet_rows(catalog, catalog.instances_direct, lang, "instance", "instance_label", "total",
+                       exclude=(EXCLUDED_INSTANCE,))
+
+
+def works_of_instance(qid_instance, lang):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    return _work_rows(catalog, catalog.by_instance.get(qid_instance, ()), lang, _depict_count)
+
+
+def per_depict(lang):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    return _facet_rows(catalog, catalog.depicts_direct, lang, "depict", "depict_label", "total")
+
+
+def works_of_depict(qid_depict, lang):
+    catalog = _CATALOG
+    if catalog is None:
+        return None
+    return _work_rows(catalog, catalog.by_depict.get(qid_depict, ()), lang, _depict_count)
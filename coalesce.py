@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Single-flight calls to the upstream services: identical calls made at the
+# same time wait for the first one and share its result. Within a process the
+# callers wait on the call in flight; across the worker processes the call
+# holds a lock on a file named after it, where its result is written, and the
+# callers of the other processes that were waiting for the lock read it from
+# there instead of calling the service again. A caller waits for the call of
+# another one only until its own deadline, after which it makes its own.
+
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+
+import metrics
+
+SETTINGS = {
+    "COALESCE_DIR": os.path.join(os.path.dirname(os.path.abspath(__file__)), "flights"),
+    # Seconds a caller waits for the call of another process before making its own
+    "COALESCE_WAIT": 60,
+    # Seconds the files of the results are kept
+    "COALESCE_KEEP": 300,
+}
+POLL = 0.05
+CLEANUP_EVERY = 100
+_FLIGHTS = {}
+_LOCK = threading.Lock()
+_CALLS = itertools.count(1)
+
+
+class Flight(object):
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def configure(config):
+    for key in SETTINGS:
+        if key in config:
+            SETTINGS[key] = config[key]
+
+
+def run(key, loader, dump=None, load=None, deadline=None):
+    # dump and load convert the result to and from JSON, to share it with other processes;
+    # deadline is the number of seconds the caller waits for an identical call in flight
+    started = time.time()
+    wait = SETTINGS["COALESCE_WAIT"] if deadline is None else min(deadline, SETTINGS["COALESCE_WAIT"])
+    with _LOCK:
+        flight = _FLIGHTS.get(key)
+        leader = flight is None
+        if leader:
+            flight = _FLIGHTS[key] = Flight()
+    if not leader:
+        if not flight.done.wait(wait):
+            metrics.REGISTRY.inc("povoconta_coalesce_timeouts_total", {"scope": "process"}, 1,
+                                 "Upstream calls made after waiting too long for an identical call in flight")
+            return loader()
+        metrics.REGISTRY.inc("povoconta_coalesced_calls_total", {"scope": "process"}, 1,
+                             "Upstream calls answered by an identical call in flight")
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    try:
+        flight.value = _shared(key, loader, dump or (lambda value: value), load or (lambda value: value),
+                               started, started + wait)
+        return flight.value
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _LOCK:
+            _FLIGHTS.pop(key, None)
+        flight.done.set()
+
+
+def _shared(key, loader, dump, load, started, deadline):
+    os.makedirs(SETTINGS["COALESCE_DIR"], exist_ok=True)
+    path = os.path.join(SETTINGS["COALESCE_DIR"], hashlib.sha1(key.encode("utf-8")).hexdigest())
+    with open(path, "a+") as file:
+        if not _lock(file, deadline):
+            metrics.REGISTRY.inc("povoconta_coalesce_timeouts_total", {"scope": "host"}, 1,
+                                 "Upstream calls made after waiting too long for an identical call in flight")
+            return loader()
+        try:
+            # A result written since this call started comes from a call that was in flight
+            file.seek(0)
+            try:
+                shared = json.loads(file.read())
+            except ValueError:
+                shared = None
+            if shared is not None and shared["key"] == key and shared["written"] >= started:
+                metrics.REGISTRY.inc("povoconta_coalesced_calls_total", {"scope": "host"}, 1,
+                                     "Upstream calls answered by an identical call in flight")
+                return load(shared["value"])
+
+            value = loader()
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps({"key": key, "written": time.time(), "value": dump(value)}))
+            file.flush()
+            return value
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+            if next(_CALLS) % CLEANUP_EVERY == 0:
+                cleanup()
+
+
+def _lock(file, deadline):
+    while True:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.time() >= deadline:
+                return False
+            time.sleep(POLL)
+
+
+def cleanup():
+    limit = time.time() - SETTINGS["COALESCE_KEEP"]
+    for entry in os.scandir(SETTINGS["COALESCE_DIR"]):
+        try:
+            if entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+        except OSError:
+            pass
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Cooperative serving mode. Under gevent, with serve.py or the gevent workers
+# of gunicorn, the standard library is patched and a blocking call only holds
+# its greenlet; the pools sized for threads are widened, and the calls that
+# block in C, out of reach of gevent, such as the file locks shared with the
+# other workers and the busy waits of SQLite, are run in its pool of native
+# threads so they do not stop every other greenlet of the process.
+
+import gevent
+from gevent import monkey
+
+import fanout
+import http_client
+
+
+def patched():
+    return monkey.is_module_patched("socket")
+
+
+def configure(config):
+    # Greenlets are cheap, so the pools sized for threads are widened
+    http_client.configure({"HTTP_POOL_MAXSIZE": config.get('ASYNC_POOL_MAXSIZE', 100)})
+    fanout.configure({"FANOUT_WORKERS": config.get('ASYNC_FANOUT_WORKERS', 200)})
+
+
+def call(func, *args, **kwargs):
+    if patched():
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
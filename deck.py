@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Shuffled deck of the works that can be presented to the users. The next
+# work is popped from the top of the deck, and a new shuffled deck is put
+# under the remaining cards by a background thread when it runs low.
+
+import logging
+import random
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WorkDeck(object):
+    def __init__(self, source, low_water=50, prioritize=False):
+        # source returns (eligible qids, qids with descriptors still to be counted)
+        self.source = source
+        self.low_water = low_water
+        self.prioritize = prioritize
+        self.cards = []
+        self.lock = threading.Lock()
+        self.refilling = False
+
+    def shuffled(self):
+        eligible, uncounted = self.source()
+        if not self.prioritize:
+            cards = list(eligible)
+            random.shuffle(cards)
+            return cards
+        uncounted = set(uncounted)
+        counted = [qid for qid in eligible if qid not in uncounted]
+        uncounted = list(uncounted)
+        random.shuffle(counted)
+        random.shuffle(uncounted)
+        # Cards are popped from the end, so the works to be counted go on top
+        return counted + uncounted
+
+    def refill(self):
+        try:
+            cards = self.shuffled()
+        except Exception:
+            LOGGER.exception("Could not refill the deck of works")
+            cards = []
+        with self.lock:
+            self.cards[:0] = cards
+            self.refilling = False
+
+    def next(self, exclude=None):
+        with self.lock:
+            qid = self._pop(exclude)
+            if len(self.cards) < self.low_water and not self.refilling:
+                self.refilling = True
+                background = qid is not None
+            else:
+                background = None
+
+        if background is None:
+            return qid
+        if background:
+            threading.Thread(target=self.refill, name="deck-refill", daemon=True).start()
+            return qid
+        self.refill()
+        with self.lock:
+            return self._pop(exclude)
+
+    def _pop(self, exclude):
+        while self.cards:
+            qid = self.cards.pop()
+            if qid != exclude:
+                return qid
+        return None
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Durable queue of the quantities saved by the users. A save is written to
+# a local SQLite journal and acknowledged at once; background workers send
+# it to Wikidata with the credentials of the user who made it, backing off
+# when the API reports lag (maxlag) or rate limiting (HTTP 429). The
+# credentials are never written to the journal: they are kept in the memory
+# of the process that received the save, and only its workers send the edit.
+# The edits of a process that is gone fail until their user saves again or
+# logs in again, when they are queued again with the new credentials.
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+import cooperative
+
+LOGGER = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+LOGIN_AGAIN = "The credentials of this edit were lost, it is sent again with the next save or login"
+# Seconds after which the edits of a process that stopped updating its heartbeat are failed
+ORPHAN_AFTER = 120
+HEARTBEAT = 10
+
+
+class BackPressure(Exception):
+    def __init__(self, retry_after):
+        super(BackPressure, self).__init__("Wikidata asked to retry after %ss" % retry_after)
+        self.retry_after = retry_after
+
+
+class EditError(Exception):
+    pass
+
+
+def check_response(response):
+    if response is None:
+        return
+    if response.status_code == 429:
+        raise BackPressure(float(response.headers.get("Retry-After", 5)))
+    if response.status_code >= 500:
+        raise EditError("HTTP %s" % response.status_code)
+    reply = response.json()
+    if "error" in reply:
+        if reply["error"].get("code") == "maxlag":
+            raise BackPressure(float(response.headers.get("Retry-After", 5)))
+        raise EditError("%s: %s" % (reply["error"].get("code"), reply["error"].get("info")))
+
+
+class EditQueue(object):
+    def __init__(self, path, handler, max_attempts=5, lease=120, poll=1):
+        # handler(qid, quantities, credentials) sends one edit and returns the response
+        self.path = path
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.poll = poll
+        self.paused_until = 0
+        self.wakeup = threading.Event()
+        self.callbacks = []
+        # Token of this queue in the journal, and id of the edit -> (owner_key, owner_secret)
+        self.owner = uuid.uuid4().hex
+        self.credentials = {}
+        self.lock = threading.Lock()
+        self.heartbeat_at = 0
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS edits ("
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "username TEXT, owner TEXT, "
+                               "qid TEXT, quantities TEXT, status TEXT, attempts INTEGER DEFAULT 0, "
+                               "next_attempt REAL, locked_until REAL DEFAULT 0, error TEXT, "
+                               "created REAL, updated REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, seen REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS edits_status ON edits (status, next_attempt)")
+            connection.execute("CREATE INDEX IF NOT EXISTS edits_username ON edits (username, status)")
+        self.heartbeat()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def transaction(self, func):
+        # Runs func(connection) and commits; SQLite waits for the locks of the
+        # other processes in C, so under gevent it runs in a native thread
+        def run():
+            connection = self.connect()
+            try:
+                with connection:
+                    return func(connection)
+            finally:
+                connection.close()
+
+        return cooperative.call(run)
+
+    def enqueue(self, username, credentials, qid, quantities):
+        now = time.time()
+        # The lock makes a worker that claims the edit at once wait for its credentials
+        with self.lock:
+            id_ = self.transaction(lambda connection: connection.execute(
+                "INSERT INTO edits (username, owner, qid, quantities, status, next_attempt, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (username, self.owner, qid, json.dumps(quantities), PENDING, now, now, now)).lastrowid)
+            self.credentials[id_] = tuple(credentials)
+        self.resume(username, credentials)
+        return id_
+
+    def resume(self, username, credentials):
+        # Queues again, with new credentials of their user, the edits whose credentials were lost
+        now = time.time()
+
+        def take(connection):
+            connection.execute("BEGIN IMMEDIATE")
+            ids = [id_ for id_, in connection.execute("SELECT id FROM edits WHERE username = ? AND status = ? "
+                                                      "AND error = ?", (username, FAILED, LOGIN_AGAIN))]
+            connection.executemany("UPDATE edits SET status = ?, owner = ?, error = NULL, attempts = 0, "
+                                   "next_attempt = ?, updated = ? WHERE id = ?",
+                                   [(PENDING, self.owner, now, now, id_) for id_ in ids])
+            return ids
+
+        with self.lock:
+            ids = self.transaction(take)
+            for id_ in ids:
+                self.credentials[id_] = tuple(credentials)
+        self.wakeup.set()
+        return len(ids)
+
+    def heartbeat(self):
+        # Tells the other processes this queue is alive, and fails the edits of the ones that are gone
+        now = time.time()
+        self.heartbeat_at = now
+
+        def beat(connection):
+            connection.execute("INSERT OR REPLACE INTO owners (owner, seen) VALUES (?, ?)", (self.owner, now))
+            connection.execute("DELETE FROM owners WHERE seen < ?", (now - ORPHAN_AFTER,))
+            connection.execute("UPDATE edits SET status = ?, error = ?, updated = ? "
+                               "WHERE status IN (?, ?) AND (owner IS NULL OR owner NOT IN (SELECT owner FROM owners))",
+                               (FAILED, LOGIN_AGAIN, now, PENDING, RUNNING))
+
+        self.transaction(beat)
+
+    def claim(self):
+        now = time.time()
+
+        def take(connection):
+            # Claims are made in a write transaction, so workers of other
+            # processes sharing the journal never take the same edit
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT id, qid, quantities, attempts FROM edits WHERE owner = ? AND "
+                                     "((status = ? AND next_attempt <= ?) OR (status = ? AND locked_until < ?)) "
+                                     "ORDER BY next_attempt LIMIT 1",
+                                     (self.owner, PENDING, now, RUNNING, now)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE edits SET status = ?, locked_until = ?, attempts = attempts + 1, "
+                                   "updated = ? WHERE id = ?", (RUNNING, now + self.lease, now, row[0]))
+            return row
+
+        return self.transaction(take)
+
+    def finish(self, id_, status, error=None, next_attempt=None):
+        now = time.time()
+        if status == PENDING:
+            self.transaction(lambda connection: connection.execute(
+                "UPDATE edits SET status = ?, error = ?, next_attempt = ?, updated = ? WHERE id = ?",
+                (status, error, next_attempt, now, id_)))
+        else:
+            self.transaction(lambda connection: connection.execute(
+                "UPDATE edits SET status = ?, error = ?, updated = ? WHERE id = ?", (status, error, now, id_)))
+        if status != PENDING:
+            # Credentials are not kept once the edit will not be tried again
+            with self.lock:
+                self.credentials.pop(id_, None)
+
+    def process(self, row):
+        id_, qid, quantities, attempts = row
+        quantities = json.loads(quantities)
+        with self.lock:
+            credentials = self.credentials.get(id_)
+        if credentials is None:
+            self.finish(id_, FAILED, LOGIN_AGAIN)
+            return
+        try:
+            check_response(self.handler(qid, quantities, credentials))
+        except BackPressure as e:
+            self.paused_until = max(self.paused_until, time.time() + e.retry_after)
+            # Lag is not the fault of the edit, so it does not use up an attempt
+            self.transaction(lambda connection: connection.execute(
+                "UPDATE edits SET attempts = attempts - 1 WHERE id = ?", (id_,)))
+            self.finish(id_, PENDING, str(e), time.time() + e.retry_after)
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                LOGGER.exception("Giving up the edit %s of %s", id_, qid)
+                self.finish(id_, FAILED, str(e))
+            else:
+                self.finish(id_, PENDING, str(e), time.time() + min(2 ** attempts * 5, 600))
+        else:
+            self.finish(id_, DONE)
+            for callback in self.callbacks:
+                try:
+                    callback(qid, quantities)
+                except Exception:
+                    LOGGER.exception("Edit callback failed")
+
+    def work(self, app):
+        while True:
+            if time.time() - self.heartbeat_at >= HEARTBEAT:
+                try:
+                    self.heartbeat()
+                except sqlite3.OperationalError:
+                    LOGGER.exception("Could not update the edit journal")
+            wait = self.paused_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                row = self.claim()
+            except sqlite3.OperationalError:
+                LOGGER.exception("Could not read the edit journal")
+                row = None
+            if row is None:
+                self.wakeup.wait(self.poll)
+                self.wakeup.clear()
+                continue
+            with app.app_context():
+                self.process(row)
+
+    def start(self, app, workers=2):
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work, args=(app,), name="edit-worker-%d" % i, daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def status(self, username):
+        def read(connection):
+            return (dict(connection.execute("SELECT status, COUNT(*) FROM edits WHERE username = ? "
+                                            "GROUP BY status", (username,)).fetchall()),
+                    connection.execute("SELECT id, qid, error, updated FROM edits WHERE username = ? AND status = ? "
+                                       "ORDER BY updated DESC LIMIT 20", (username, FAILED)).fetchall())
+
+        counts, failed = self.transaction(read)
+        return {"pending": counts.get(PENDING, 0) + counts.get(RUNNING, 0),
+                "done": counts.get(DONE, 0),
+                "failed": counts.get(FAILED, 0),
+                "failures": [{"id": id_, "qid": qid, "error": error, "updated": updated}
+                             for id_, qid, error, updated in failed]}
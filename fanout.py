@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Runs the independent upstream calls of a route at the same time, so the
+# route waits for the slowest call instead of the sum of all of them. The
+# calls that miss the deadline of the route take their default value, or
+# fail the route; those already running are not stopped, they finish in the
+# background and keep their slot of the rate limiter until then.
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+
+EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="fanout")
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, deadline, names, results):
+        super(DeadlineExceeded, self).__init__("Upstream calls did not finish in %ss: %s" % (deadline, ", ".join(names)))
+        self.names = names
+        # Results of the calls that finished in time
+        self.results = results
+
+
+def configure(config):
+    global EXECUTOR
+    if "FANOUT_WORKERS" in config:
+        EXECUTOR = ThreadPoolExecutor(max_workers=config["FANOUT_WORKERS"], thread_name_prefix="fanout")
+
+
+def submit(func, *args, **kwargs):
+    # Each call runs in a copy of the caller's context, so the request
+    # context and g of the route are visible to it
+    context = contextvars.copy_context()
+    return EXECUTOR.submit(context.run, func, *args, **kwargs)
+
+
+def gather(calls, deadline=None, defaults=None):
+    # defaults are the values of the calls that may miss the deadline without failing the route
+    defaults = defaults or {}
+    futures = {name: submit(*call) for name, call in calls.items()}
+    done, not_done = wait(futures.values(), timeout=deadline)
+    for future in not_done:
+        # Only the calls still queued are cancelled
+        future.cancel()
+    late = [name for name, future in futures.items() if future in not_done]
+    if any(name not in defaults for name in late):
+        raise DeadlineExceeded(deadline, late, {name: future.result() for name, future in futures.items()
+                                                if future in done and future.exception() is None})
+    return {name: defaults[name] if name in late else future.result() for name, future in futures.items()}
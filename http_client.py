@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Shared HTTP session for the anonymous calls to query.wikidata.org and
+# www.wikidata.org. Connections are kept alive in a pool sized for the
+# threads of one worker process, every call has a timeout and transient
+# failures are retried with backoff, honoring the Retry-After header. The
+# queries to query.wikidata.org have a session of their own that does not
+# retry a 429, which the rate limiter of the workers handles instead, nor a
+# read timeout, as the service keeps running the query that was given up.
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+USER_AGENT = 'Wiki Museu do Ipiranga - Quantos tem? 1.0'
+SETTINGS = {
+    "HTTP_CONNECT_TIMEOUT": 3.05,
+    "HTTP_READ_TIMEOUT": 30,
+    "HTTP_RETRIES": 3,
+    "HTTP_BACKOFF_FACTOR": 0.5,
+    "HTTP_MAX_RETRY_AFTER": 10,
+    # One pool per host (query.wikidata.org, www.wikidata.org, commons)
+    "HTTP_POOL_CONNECTIONS": 4,
+    # Connections kept per host, should match the threads of a worker
+    "HTTP_POOL_MAXSIZE": 10,
+}
+
+
+class CappedRetry(Retry):
+    def get_retry_after(self, response):
+        retry_after = super(CappedRetry, self).get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, SETTINGS["HTTP_MAX_RETRY_AFTER"])
+
+
+class WdqsRetry(CappedRetry):
+    # urllib3 retries any 429 with a Retry-After header, even when it is not in status_forcelist
+    RETRY_AFTER_STATUS_CODES = frozenset([413, 503])
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+WDQS_RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def build_session(retry_class=CappedRetry, statuses=RETRY_STATUSES, read=None):
+    retry = retry_class(total=SETTINGS["HTTP_RETRIES"],
+                        read=read,
+                        backoff_factor=SETTINGS["HTTP_BACKOFF_FACTOR"],
+                        status_forcelist=statuses,
+                        allowed_methods=frozenset(["GET", "POST"]),
+                        respect_retry_after_header=True,
+                        raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=SETTINGS["HTTP_POOL_CONNECTIONS"],
+                          pool_maxsize=SETTINGS["HTTP_POOL_MAXSIZE"],
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-agent"] = USER_AGENT
+    return session
+
+
+SESSION = build_session()
+WDQS_SESSION = build_session(WdqsRetry, WDQS_RETRY_STATUSES, read=0)
+
+
+def configure(config):
+    global SESSION, WDQS_SESSION
+    for key in SETTINGS:
+        if key in config:
+            SETTINGS[key] = config[key]
+    SESSION = build_session()
+    WDQS_SESSION = build_session(WdqsRetry, WDQS_RETRY_STATUSES, read=0)
+
+
+def timeout():
+    return SETTINGS["HTTP_CONNECT_TIMEOUT"], SETTINGS["HTTP_READ_TIMEOUT"]
+
+
+def get(url, **kwargs):
+    kwargs.setdefault("timeout", timeout())
+    return SESSION.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", timeout())
+    return SESSION.post(url, **kwargs)
+
+
+def post_wdqs(url, **kwargs):
+    # A 429 is returned at once, so the caller pauses every worker, and a query that
+    # timed out is not sent again under the same slot
+    kwargs.setdefault("timeout", timeout())
+    return WDQS_SESSION.post(url, **kwargs)
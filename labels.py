@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Labels and descriptions of the entities shown by the tool, in all the
+# languages it serves. The labels of every entity referenced by the collection
+# are bulk loaded with the catalog; the ones of other entities are fetched from
+# the Wikidata API when first asked for, in batches, and kept for a while. The
+# fallback between languages is applied here, so the queries do not need to
+# join the labels.
+
+import threading
+import time
+
+LANGUAGES = ("pt-br", "pt", "en")
+LABEL_FALLBACK = ("pt-br", "pt", "en")
+DESCRIPTION_FALLBACK = ("pt-br", "pt")
+# Seconds the labels fetched on demand are kept
+FETCHED_TTL = 3600
+
+
+def pick(values, lang, fallback):
+    for lang_ in (lang,) + fallback:
+        if lang_ in values:
+            return values[lang_]
+    return None
+
+
+def entity_values(entity, key):
+    return {lang: value["value"] for lang, value in entity.get(key, {}).items()}
+
+
+class LabelStore(object):
+    def __init__(self):
+        # qid -> {lang: text}, replaced as a whole by every load of the catalog
+        self.labels = {}
+        self.descriptions = {}
+        # qid -> (labels, descriptions, fetched at) of the entities out of the catalog
+        self.fetched = {}
+        self.lock = threading.Lock()
+
+    def replace(self, labels, descriptions):
+        self.labels, self.descriptions = labels, descriptions
+
+    def entry(self, qid):
+        labels, descriptions = self.labels, self.descriptions
+        if qid in labels or qid in descriptions:
+            return labels.get(qid, {}), descriptions.get(qid, {})
+        fetched = self.fetched.get(qid)
+        if fetched is not None and time.time() - fetched[2] < FETCHED_TTL:
+            return fetched[0], fetched[1]
+        return None
+
+    def names(self, qids, lang):
+        # qid -> (label, description), with the QID when there is no label
+        qids = list(dict.fromkeys(qids))
+        missing = [qid for qid in qids if self.entry(qid) is None]
+        if missing:
+            self.fetch(missing)
+        names = {}
+        for qid in qids:
+            labels, descriptions = self.entry(qid) or ({}, {})
+            names[qid] = (pick(labels, lang, LABEL_FALLBACK) or qid,
+                          pick(descriptions, lang, DESCRIPTION_FALLBACK) or "")
+        return names
+
+    def name(self, qid, lang):
+        return self.names([qid], lang)[qid]
+
+    def label(self, qid, lang):
+        # Only what the store already has, for lists too long to be fetched
+        labels = (self.entry(qid) or ({}, {}))[0]
+        return pick(labels, lang, LABEL_FALLBACK) or qid
+
+    def fetch(self, qids):
+        # Imported here, as query imports the catalog, which imports this module
+        import query
+
+        for i in range(0, len(qids), query.WBGETENTITIES_LIMIT):
+            batch = qids[i:i + query.WBGETENTITIES_LIMIT]
+            params = {
+                "action": "wbgetentities",
+                "ids": "|".join(batch),
+                "props": "labels|descriptions",
+                "languages": "|".join(LANGUAGES),
+                "format": "json"
+            }
+            # Raises query.ApiError when the API answers with an error, so nothing is kept
+            entities = query.wbgetentities(params, "labels")["entities"]
+            now = time.time()
+            with self.lock:
+                fetched = dict((qid, values) for qid, values in self.fetched.items()
+                               if now - values[2] < FETCHED_TTL)
+                # Entities marked as missing are kept too, so they are not asked for again; the ones
+                # absent from the answer are asked for with the next call
+                for qid in batch:
+                    entity = entities.get(qid)
+                    if entity is not None:
+                        fetched[qid] = (entity_values(entity, "labels"), entity_values(entity, "descriptions"), now)
+                self.fetched = fetched
+
+
+STORE = LabelStore()
+
+
+def names(qids, lang):
+    return STORE.names(qids, lang)
+
+
+def name(qid, lang):
+    return STORE.name(qid, lang)
+
+
+def label(qid, lang):
+    return STORE.label(qid, lang)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Instrumentation of the calls to the upstream services. Each call is timed
+# and recorded in g.profiling, which is sent back in the Server-Timing header
+# of the response, and in the latency histograms of the worker process, which
+# are exported in the Prometheus text format at /metrics.
+
+import threading
+import time
+
+from flask import g, has_app_context
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.help = {}
+
+    def observe(self, name, labels, value, help_=""):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help.setdefault(name, help_)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name, labels, value=1, help_=""):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help.setdefault(name, help_)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self, gauges=()):
+        # gauges is a list of (name, help, labels, value) read at export time
+        lines = []
+        with self.lock:
+            for name in sorted(set(key[0] for key in self.histograms)):
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s histogram" % name)
+                for (name_, labels), histogram in sorted(self.histograms.items()):
+                    if name_ != name:
+                        continue
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", bound),)), count))
+                    lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", "+Inf"),)), histogram.count))
+                    lines.append("%s_sum%s %f" % (name, format_labels(labels), histogram.sum))
+                    lines.append("%s_count%s %d" % (name, format_labels(labels), histogram.count))
+            for name in sorted(set(key[0] for key in self.counters)):
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s counter" % name)
+                for (name_, labels), value in sorted(self.counters.items()):
+                    if name_ == name:
+                        lines.append("%s%s %d" % (name, format_labels(labels), value))
+        for name, help_, labels, value in gauges:
+            lines.append("# HELP %s %s" % (name, help_))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s%s %s" % (name, format_labels(tuple(sorted(labels.items()))), value))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in labels)
+
+
+REGISTRY = Registry()
+
+
+def timed(upstream, family, call, *args, **kwargs):
+    # Makes one upstream call and records its duration, size and status
+    started = time.perf_counter()
+    response = None
+    try:
+        response = call(*args, **kwargs)
+        return response
+    finally:
+        if response is None:
+            record(upstream, family, time.perf_counter() - started, "error", 0)
+        else:
+            record(upstream, family, time.perf_counter() - started, response.status_code, len(response.content))
+
+
+def record(upstream, family, duration, status, size):
+    family = family or "other"
+    # Labels are strings, so the series of a successful and of a failed call can be sorted together
+    labels = {"upstream": upstream, "family": family, "status": str(status)}
+    REGISTRY.observe("povoconta_upstream_request_duration_seconds", labels, duration,
+                     "Duration of the calls to the upstream services")
+    REGISTRY.inc("povoconta_upstream_response_bytes_total", labels, size,
+                  "Bytes received from the upstream services")
+
+    # Calls made outside of a request, by the background threads, only go to the histograms
+    if has_app_context() and g.get("profiling") is not None:
+        g.profiling.append({"upstream": upstream, "family": family, "duration": duration,
+                            "bytes": size, "status": status})
+
+
+def observe_route(endpoint, status, duration):
+    REGISTRY.observe("povoconta_request_duration_seconds", {"endpoint": endpoint, "status": str(status)}, duration,
+                     "Duration of the requests served by the application")
+
+
+def server_timing(profiling, total=None):
+    entries = ['%s;desc="%s";dur=%.1f' % (entry["upstream"], entry["family"], entry["duration"] * 1000)
+               for entry in profiling]
+    if total is not None:
+        entries.append("total;dur=%.1f" % (total * 1000))
+    return ", ".join(entries)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Loads in the background what the next page will probably need, so it is
+# already in the caches when the user gets there.
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def submit(self, key, func, *args):
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        self.executor.submit(self.run, key, func, *args)
+        return True
+
+    def run(self, key, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            LOGGER.exception("Could not prefetch %s", key)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Progress of the counting: how many descriptors (P180 statements) of the works
+# already have a quantity (P1114), in total and by collection, creator and
+# descriptor. The counters are kept in memory and updated work by work: when
+# the catalog changes, only the works that were replaced are applied again,
+# and every edit saved to Wikidata marks its statements as counted.
+
+import threading
+import time
+from bisect import bisect_left, insort
+
+import catalog
+
+KINDS = ("collection", "creator", "depict")
+TOTAL = ("total", "")
+
+
+class ProgressTracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # qid -> Work of the catalog last applied
+        self.works = {}
+        # qid -> {statement id: (depicted qid, counted)}
+        self.statements = {}
+        # qid -> creators of the work and of its collections, as in the catalog index
+        self.creators = {}
+        # (kind, qid) -> [statements, counted statements, works, complete works]
+        self.counters = {}
+        # kind -> [(counted - statements, qid)], those with more descriptors left to count first
+        self.order = dict((kind, []) for kind in KINDS)
+        self.version = 0
+        self.updated = None
+
+    def load(self, catalog_):
+        # Called with every new catalog; the works that did not change are the same objects
+        with self.lock:
+            for qid in [qid for qid in self.works if qid not in catalog_.works]:
+                self._apply(qid, -1)
+                del self.works[qid]
+                del self.statements[qid]
+                del self.creators[qid]
+            for qid, work in catalog_.works.items():
+                creators = frozenset(catalog_.inherited(work, work.creators, "P170"))
+                if self.works.get(qid) is work and self.creators[qid] == creators:
+                    continue
+                if qid in self.works:
+                    self._apply(qid, -1)
+                self.works[qid] = work
+                self.creators[qid] = creators
+                self.statements[qid] = dict((statement, (value, quantity is not None))
+                                            for statement, value, quantity in work.depicts)
+                self._apply(qid, 1)
+            self._changed()
+
+    def record(self, qid, quantities):
+        # Called with every edit saved to Wikidata
+        with self.lock:
+            statements = self.statements.get(qid)
+            if statements is None:
+                return
+            self._apply(qid, -1)
+            for statement in quantities:
+                if statement in statements:
+                    statements[statement] = (statements[statement][0], True)
+            self._apply(qid, 1)
+            self._changed()
+
+    def _contribution(self, qid):
+        work = self.works[qid]
+        statements = self.statements[qid].values()
+        total = len(statements)
+        counted = sum(1 for _, counted_ in statements if counted_)
+        groups = dict.fromkeys([TOTAL] +
+                               [("collection", collection) for collection in work.collections
+                                if collection != catalog.ROOT_COLLECTION] +
+                               [("creator", creator) for creator in self.creators[qid]], (total, counted))
+        for value, counted_ in statements:
+            total_, counted__ = groups.get(("depict", value), (0, 0))
+            groups["depict", value] = (total_ + 1, counted__ + counted_)
+        return groups
+
+    def _apply(self, qid, sign):
+        for key, (total, counted) in self._contribution(qid).items():
+            counter = self.counters.setdefault(key, [0, 0, 0, 0])
+            order = self.order.get(key[0])
+            if order is not None and counter[2]:
+                del order[bisect_left(order, (counter[1] - counter[0], key[1]))]
+            counter[0] += sign * total
+            counter[1] += sign * counted
+            counter[2] += sign
+            counter[3] += sign * (total == counted)
+            if not counter[2]:
+                del self.counters[key]
+            elif order is not None:
+                insort(order, (counter[1] - counter[0], key[1]))
+
+    def _changed(self):
+        self.version += 1
+        self.updated = time.time()
+
+    def total(self):
+        return self.counters.get(TOTAL, [0, 0, 0, 0])
+
+    def breakdown(self, kind, limit=None):
+        # (qid, counter) of a kind, those with more descriptors left to count first
+        with self.lock:
+            return [(qid, list(self.counters[kind, qid])) for _, qid in self.order[kind][:limit]]
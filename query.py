@@ -1,37 +1,149 @@
+import catalog
+import coalesce
+import http_client
+import labels
+import logging
+import metrics
 import requests
+import results
+import roman
+import sparql
+import throttle
+import time
+from math import ceil
 from random import random
+from urllib.parse import quote, urlencode
+from cache import ResponseCache, normalize
+from deck import WorkDeck
+from views import MaterializedViews
 
-SESSION = requests.Session()
-SESSION.params["maxAge"] = 0
+LOGGER = logging.getLogger(__name__)
 WIKIDATA_API_ENDPOINT = 'https://www.wikidata.org/w/api.php'
+SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
+WBGETENTITIES_LIMIT = 50
+# Seconds every worker stops querying WDQS after a 429 without Retry-After
+THROTTLE_PAUSE = 60
+CACHE = ResponseCache()
+DEFAULT_TTL = 600
+# Seconds each query family is served from the cache before being refreshed
+CACHE_TTL = {
+    "per_collection": 3600,
+    "per_creator": 3600,
+    "per_decade": 3600,
+    "per_instance": 3600,
+    "per_depict": 3600,
+    "total_works": 3600,
+    "tutorial_collections": 86400,
+    "tutorial_images": 86400,
+    "tutorial_total": 86400,
+    "tutorial_total_collection": 86400,
+    "collection_data": 3600,
+    "creator_data": 3600,
+    "works_in_collection": 600,
+    "works_of_creator": 600,
+    "works_of_decade": 600,
+    "works_of_instance": 600,
+    "works_of_depict": 600,
+    "item": 120,
+    "next_qid": 0,
+    "eligible_works": 3600,
+    "uncounted_works": 3600,
+    "catalog": 0,
+}
+
+
+DECK = WorkDeck(lambda: eligible_works())
+# The facet pages and the total of works, precomputed for each language
+VIEWS = MaterializedViews()
 
 
 # API
-def get_p180(qid, lang):
+ITEM_PROPERTIES = {"P31": "instances", "P170": "creators", "P186": "materials", "P88": "commissioners"}
+
+
+def get_item(qid, lang):
+    return CACHE.get(item_key(qid, lang), CACHE_TTL["item"], lambda: fetch_item(qid, lang))
+
+
+def item_key(qid, lang):
+    return "wbgetentities item " + qid + " " + lang
+
+
+def forget_item(qid, langs):
+    for lang in langs:
+        CACHE.invalidate(item_key(qid, lang))
+
+
+def fetch_item(qid, lang):
+    # Everything the item page shows comes from the claims of the work, and
+    # the labels from the label store
     params = {
         "action": "wbgetentities",
         "ids": qid,
-        "props": "claims|labels",
+        "props": "claims",
         "format": "json"
     }
+    entity = wbgetentities(params, "item").get("entities", {}).get(qid, {})
+    claims = entity.get("claims", {})
+    images = catalog.claim_values(claims, "P18")
+    if "missing" in entity or not images:
+        return None
+
+    referenced = {prop: catalog.claim_ids(claims, prop) for prop in ITEM_PROPERTIES}
+    p180s = [p180 for p180 in claims.get("P180", []) if p180["mainsnak"].get("snaktype") == "value"]
+    depicted = [p180["mainsnak"]["datavalue"]["value"]["id"] for p180 in p180s]
+    names = labels.names([qid] + [qid_ for qids in referenced.values() for qid_ in qids] + depicted, lang)
+
+    item = {"work_label": names[qid][0],
+            "image": quote(images[0]),
+            "date": format_date(catalog.claim_values(claims, "P571"))}
+    for prop, attribute in ITEM_PROPERTIES.items():
+        item[attribute] = [{"qid": qid_, "label": names[qid_][0]} for qid_ in referenced[prop]]
 
-    result = SESSION.get(url=WIKIDATA_API_ENDPOINT, params=params)
-    data = result.json()
     depicts = []
-    try:
-        p180s = data["entities"][qid]["claims"]["P180"]
-        for p180 in p180s:
-            quantity, quantity_hash, show_validate = get_p1114(p180)
-            qid = p180["mainsnak"]["datavalue"]["value"]["id"]
-            id_ = p180["id"]
-            name, description = get_name(qid, lang, "name|description")
-            depict = {"depict_qid": qid, "depict_id": id_, "depict_label": name, "depict_desc": description, "quantity_value": quantity, "quantity_hash": quantity_hash}
-            depicts.append(depict)
-    except:
-        pass
-
-    SESSION.close()
-    return depicts
+    for p180 in p180s:
+        quantity, quantity_hash, show_validate = get_p1114(p180)
+        qid_ = p180["mainsnak"]["datavalue"]["value"]["id"]
+        name, description = names[qid_]
+        depicts.append({"depict_qid": qid_, "depict_id": p180["id"], "depict_label": name, "depict_desc": description,
+                        "quantity_value": quantity, "quantity_hash": quantity_hash})
+    item["depicts"] = depicts
+    return item
+
+
+def format_date(values):
+    if not values:
+        return ""
+    time, precision = values[0]["time"], values[0]["precision"]
+    year = int(time[:time.index("-", 1)])
+    if precision == 7:
+        # Roman numerals have no negative numbers, the centuries before Christ are marked as such
+        if year < 0:
+            return "Século " + roman.toRoman(ceil(-year / 100)) + " a.C."
+        return "Século " + roman.toRoman(ceil(year / 100))
+    if precision == 8:
+        return "Década de " + str(year)
+    if precision > 8:
+        return str(year)
+    return ""
+
+
+class ApiError(Exception):
+    pass
+
+
+def wbgetentities(params, family):
+    # Identical calls made at the same time share one request
+    key = "wbgetentities " + urlencode(sorted(params.items()))
+
+    def load():
+        reply = metrics.timed("wikidata_api", family, http_client.get, WIKIDATA_API_ENDPOINT, params=params).json()
+        # Errors such as maxlag or ratelimited come without entities, and must not pass for missing entities
+        if "error" in reply or "entities" not in reply:
+            raise ApiError("wbgetentities failed: %s" % reply.get("error", {}).get("code", "no entities"))
+        return reply
+
+    return coalesce.run(key, load, deadline=throttle.deadline_for())
 
 
 def get_p1114(snak):
@@ -42,247 +154,225 @@ def get_p1114(snak):
 
 
 def get_name(qid, lang="pt-br", object="name"):
-    params = {
-        "action": "wbgetentities",
-        "ids": qid,
-        "props": "labels|descriptions",
-        "format": "json"
-    }
-    result = SESSION.get(url=WIKIDATA_API_ENDPOINT, params=params)
-    data = result.json()
-    name = ""
-    description = ""
     try:
-        labels = data["entities"][qid]["labels"]
-        descriptions = data["entities"][qid]["descriptions"]
-
-        if lang in labels:
-            name = labels[lang]["value"]
-            if "descriptions" in data["entities"][qid] and lang in descriptions:
-                description = descriptions[lang]["value"]
-        elif "pt-br" in labels:
-            name = labels["pt-br"]["value"]
-            if "descriptions" in data["entities"][qid] and "pt-br" in descriptions:
-                description = descriptions["pt-br"]["value"]
-        elif "pt" in labels:
-            name = labels["pt"]["value"]
-            if "descriptions" in data["entities"][qid] and "pt" in descriptions:
-                description = descriptions["pt"]["value"]
-        elif "en" in labels:
-            name = labels["en"]["value"]
-            if "descriptions" in data["entities"][qid] and "en" in descriptions:
-                description = descriptions["en"]["value"]
-        else:
-            name = qid
-
-        if lang in descriptions:
-            description = descriptions[lang]["value"]
-        elif "pt-br" in descriptions:
-            description = descriptions["pt-br"]["value"]
-        elif "pt" in descriptions:
-            description = descriptions["pt"]["value"]
-        else:
-            description = ""
-    except:
-        pass
-
-    SESSION.close()
+        name, description = labels.name(qid, lang)
+    except (ApiError, requests.RequestException):
+        LOGGER.exception("Could not fetch the name of %s", qid)
+        name, description = "", ""
+
     if object=="name":
         return name
     else:
         return name, description
 
 
+def with_labels(rows, lang, **columns):
+    # Adds to the rows a column with the label of the entity of another column
+    if not rows:
+        return rows
+    names = labels.names([getattr(row, column) for row in rows for column in columns.values()
+                          if getattr(row, column)], lang)
+    row_type = results.row_type(rows[0]._fields + tuple(columns))
+    return [row_type(*row, *(names[getattr(row, column)][0] if getattr(row, column) else ""
+                             for column in columns.values()))
+            for row in rows]
+
+
+def retry_after(response):
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return THROTTLE_PAUSE
+
+
 # Query
-def query_wikidata(query):
-    url = "https://query.wikidata.org/sparql"
-    params = {
-        "query": query,
-        "format": "json"
-    }
-    result = SESSION.post(url=url, params=params, headers={'User-agent': 'Wiki Museu do Ipiranga - Quantos tem? 1.0'})
-    data = result.json()
-    SESSION.close()
-    return data
+def query_template(name, **params):
+    # The cache key is the fingerprint of the query, its text is only built when it is sent
+    query = sparql.bind(name, **params)
+    ttl = CACHE_TTL.get(query.family, DEFAULT_TTL)
+    return CACHE.get(query.fingerprint, ttl, lambda: fetch_wikidata(query.render(), query.family))
+
+
+def query_wikidata(query, family=None):
+    ttl = CACHE_TTL.get(family, DEFAULT_TTL)
+    return CACHE.get(normalize(query), ttl, lambda: fetch_wikidata(query, family))
+
+
+def fetch_wikidata(query, family=None):
+    # Identical queries sent at the same time share one request
+    # A page waits for an identical query of the background threads only until its own deadline
+    return coalesce.run("wdqs " + normalize(query), lambda: list(stream_wikidata(query, family)),
+                        results.dump, results.load, throttle.deadline_for())
+
+
+def stream_wikidata(query, family=None, priority=None):
+    # Yields the rows of the results while they are downloaded, once the
+    # rate limiter shared by the workers gives the query a slot
+    slot = throttle.acquire(priority)
+    started = time.perf_counter()
+    status, size = "error", 0
+    try:
+        response = http_client.post_wdqs(SPARQL_ENDPOINT, data={"query": query, "maxAge": 0},
+                                         headers={"Accept": results.MIMETYPE}, stream=True)
+        with response:
+            status = response.status_code
+            if status == 429:
+                throttle.pause(retry_after(response))
+            response.raise_for_status()
+            yield from results.stream(response)
+            size = response.raw.tell()
+    finally:
+        throttle.release(slot)
+        metrics.record("wdqs", family, time.perf_counter() - started, status, size)
 
 
 def per_collection(lang="pt-br"):
-    data = query_wikidata("SELECT ?collection ?collection_label "
-                          "(COUNT(?work) AS ?num_works) WHERE { "
-                          "?work wdt:P195 wd:Q56677470. "
-                          "?work wdt:P180 ?depicts. "
-                          "?work wdt:P195 ?collection. "
-                          "FILTER(?collection != wd:Q56677470). "
-                          "?work wdt:P18 ?image. "
-                          "?collection rdfs:label ?collection_label. "
-                          "FILTER((LANG(?collection_label)) = \""+lang+"\") "
-                          "} GROUP BY ?collection ?collection_label  "
-                          "ORDER BY ?num_works")
-    return data
+    return VIEWS.get("per_collection", lang)
+
+
+def build_per_collection(lang):
+    data = catalog.per_collection(lang)
+    if data is not None:
+        return data
+    return query_template("per_collection", lang=lang)
 
 
 def works_in_collection(qid_collection):
-    data = query_wikidata("SELECT DISTINCT ?work ?image ?work_label"
-                          "(COUNT(DISTINCT (?depicts_p)) AS ?count_depicts) WHERE {"
-                          "SERVICE wikibase:label { bd:serviceParam wikibase:language 'pt-br,pt,en'. ?work rdfs:label ?work_label}"
-                          "?work wdt:P195 wd:"+qid_collection+";"
-                          "wdt:P180 ?depicts;"
-                          "wdt:P18 ?image."
-                          "OPTIONAL {?work p:P180 ?depicts_p."
-                          "?depicts_p pq:P1114 ?depicts_quantity.}"
-                          "} GROUP BY ?work ?image ?work_label ORDER BY (?count_depicts)")
-    return data
+    data = catalog.works_in_collection(qid_collection)
+    if data is not None:
+        return data
+    return query_template("works_in_collection", collection=qid_collection)
 
 
 def collection_data(qid_collection, lang="pt-br"):
-    data = query_wikidata("SELECT DISTINCT ?collection ?collection_label "
-                          "?collection_category ?collection_article "
-                          "?named_after ?named_after_label ?named_after_article "
-                          "(COUNT(?work) AS ?total) "
-                          "(COUNT(?work_scope) AS ?total_scope) WHERE { "
-                          "BIND(wd:"+qid_collection+" AS ?collection) "
-                          "OPTIONAL {?commons_collection schema:about ?collection; "
-                          "schema:name ?collection_category; "
-                          "schema:isPartOf <https://commons.wikimedia.org/>.} "
-                          "OPTIONAL {?article_collection schema:about ?collection; "
-                          "schema:name ?collection_article; "
-                          "schema:isPartOf <https://pt.wikipedia.org/>.} "
-                          "?collection rdfs:label ?collection_label. "
-                          "FILTER(LANG(?collection_label)='"+lang+"') "
-                          "OPTIONAL {?collection wdt:P138 ?named_after. "
-                          "?named_after rdfs:label ?named_after_label. "
-                          "FILTER(LANG(?named_after_label)='"+lang+"') "
-                          "OPTIONAL{?article schema:about ?named_after; "
-                          "schema:name ?named_after_article; "
-                          "schema:isPartOf <https://pt.wikipedia.org/>.}} "
-                          "?work wdt:P195 ?collection. "
-                          "OPTIONAL {?work wdt:P18 ?image; "
-                          "wdt:P180 ?depic. BIND(1 AS ?work_scope)} "
-                          "} GROUP BY ?named_after ?named_after_label ?named_after_article ?collection ?collection_label ?collection_category ?collection_article")
-    return data
+    rows = query_template("collection_data", collection=qid_collection)
+    return with_labels(rows, lang, collection_label="collection", named_after_label="named_after")
 
 
 def per_creator(lang="pt-br"):
-    data = query_wikidata("SELECT DISTINCT ?creator ?creator_label (COUNT(?work) AS ?total) WHERE { "
-                          "?work wdt:P195 wd:Q56677470. "
-                          "{?work wdt:P18 ?image; wdt:P180 ?depict; wdt:P170 ?creator.} "
-                          "UNION {?work_ wdt:P170 ?creator. ?work wdt:P195 ?work_; wdt:P18 ?image; wdt:P180 ?depict.} "
-                          "?creator rdfs:label ?creator_label."
-                          "FILTER((LANG(?creator_label)) = '"+lang+"')"
-                          "} GROUP BY ?creator ?creator_label ORDER BY (?total)")
-    return data
+    return VIEWS.get("per_creator", lang)
+
+
+def build_per_creator(lang):
+    data = catalog.per_creator(lang)
+    if data is not None:
+        return data
+    return query_template("per_creator", lang=lang)
 
 
 def total_works():
-    data = query_wikidata("SELECT (COUNT(DISTINCT(?work)) AS ?number_works) WHERE {"
-                          "?work wdt:P195 wd:Q56677470. "
-                          "?work wdt:P180 ?depicts. "
-                          "?work wdt:P18 ?image.}")
-    if "results" in data:
-        return int(data["results"]["bindings"][0]["number_works"]["value"])
+    return VIEWS.get("total_works")
+
+
+def build_total_works():
+    total = catalog.total_works()
+    if total is not None:
+        return total
+    rows = query_template("total_works")
+    if rows:
+        return int(rows[0].number_works)
 
     return 0
 
 
 def works_of_creator(qid_creator, lang="pt-br"):
-    data = query_wikidata("SELECT DISTINCT ?work ?work_label ?image "
-                          "(COUNT(?depict) AS ?total) WHERE { "
-                          "BIND(wd:"+qid_creator+" AS ?creator) "
-                          "?work rdfs:label ?work_label. "
-                          "FILTER((LANG(?work_label)) = '"+lang+"') "
-                          "?work wdt:P195 wd:Q56677470. "
-                          "{?work wdt:P18 ?image; "
-                          "wdt:P180 ?depict; "
-                          "wdt:P170 ?creator.} "
-                          "UNION "
-                          "{?work_ wdt:P170 ?creator. "
-                          "?work wdt:P195 ?work_; "
-                          "wdt:P18 ?image; "
-                          "wdt:P180 ?depict.} "
-                          "} GROUP BY ?work ?work_label ?image ORDER BY (?total)")
-    return data
-
-
-def creator_data(qid_creator, lang="pt-br", lang_fallback="pt"):
-    data = query_wikidata("SELECT DISTINCT ?creator_ ?creator_article ?creator_label "
-                          "(COUNT(?work) AS ?total) "
-                          "(COUNT(?work_scope) AS ?total_scope) WHERE { "
-                          "BIND(wd:"+qid_creator+" AS ?creator_) "
-                          "OPTIONAL {?article_ schema:about ?creator_;"
-                          "schema:inLanguage 'pt';"
-                          "schema:name ?creator_article.}"
-                          "OPTIONAL {?creator_ rdfs:label ?creator_label_ptbr."
-                          "FILTER(LANG(?creator_label_ptbr)='"+lang+"').}"
-                          "OPTIONAL {?creator_ rdfs:label ?creator_label_pt."
-                          "FILTER(LANG(?creator_label_pt)='"+lang_fallback+"').}"
-                          "BIND(IF(BOUND(?creator_label_ptbr),?creator_label_ptbr,"
-                          "IF(BOUND(?creator_label_pt),?creator_label_pt,'')) AS ?creator_label) "
-                          "?work wdt:P195 wd:Q56677470. "
-                          "{?work wdt:P170 ?creator_} "
-                          "UNION {?work_ wdt:P170 ?creator_. "
-                          "?work wdt:P195 ?work_.} "
-                          "OPTIONAL {?work wdt:P18 ?image;"
-                          "wdt:P180 ?depict."
-                          "BIND(1 AS ?work_scope)}"
-                          "} GROUP BY ?creator_ ?creator_article ?creator_label")
-    return data
+    data = catalog.works_of_creator(qid_creator, lang)
+    if data is not None:
+        return data
+    return query_template("works_of_creator", creator=qid_creator, lang=lang)
+
+
+def creator_data(qid_creator, lang="pt-br"):
+    rows = query_template("creator_data", creator=qid_creator)
+    return with_labels(rows, lang, creator_label="creator_")
 
 
 def per_decade(indeterminate="Década indeterminada"):
-    data = query_wikidata("SELECT DISTINCT ?decade WHERE {?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts. ?work p:P571 ?decade_aux. ?decade_aux psv:P571 ?decade_. ?decade_ wikibase:timeValue ?value. ?decade_ wikibase:timePrecision ?precision. BIND(IF(?precision = 7,CONCAT('"+indeterminate+"'), STR(10*FLOOR(YEAR(?value)/10))) AS ?decade)} ORDER BY ?decade")
-    return data
+    return VIEWS.get("per_decade", indeterminate)
+
+
+def build_per_decade(indeterminate):
+    data = catalog.per_decade(indeterminate)
+    if data is not None:
+        return data
+    return query_template("per_decade", indeterminate=indeterminate)
 
 
 def works_of_decade(decade, lang="pt-br", indeterminate="Década indeterminada"):
-    data = query_wikidata("SELECT DISTINCT ?work ?work_label ?image (COUNT(?depicts) AS ?total) WHERE { SERVICE wikibase:label { bd:serviceParam wikibase:language 'pt-br,pt,en'. } ?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts. ?work p:P571 ?decade_aux. ?decade_aux psv:P571 ?decade_. ?decade_ wikibase:timeValue ?value. ?decade_ wikibase:timePrecision ?precision. ?work rdfs:label ?work_label. FILTER((LANG(?work_label)) = \""+lang+"\") BIND(IF(?precision = 7,CONCAT('"+indeterminate+"'), STR(10*FLOOR(YEAR(?value)/10))) AS ?decade) FILTER(?decade=\""+decade+"\")} GROUP BY ?work ?work_label ?image ORDER BY ?total")
-    return data
+    data = catalog.works_of_decade(decade, lang, indeterminate)
+    if data is not None:
+        return data
+    return query_template("works_of_decade", decade=decade, lang=lang, indeterminate=indeterminate)
 
 
 def per_instance(lang="pt-br"):
-    data = query_wikidata("SELECT DISTINCT ?instance ?instance_label (COUNT(DISTINCT(?work)) AS ?total) WHERE {?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts; wdt:P31 ?instance. ?instance rdfs:label ?instance_label.FILTER(LANG(?instance_label)=\""+lang+"\") FILTER(?instance!=wd:Q18593264)} GROUP BY ?instance ?instance_label ORDER BY ?total")
-    return data
+    return VIEWS.get("per_instance", lang)
+
+
+def build_per_instance(lang):
+    data = catalog.per_instance(lang)
+    if data is not None:
+        return data
+    return query_template("per_instance", lang=lang)
 
 
 def works_of_instance(qid_instance, lang="pt-br"):
-    data = query_wikidata("SELECT DISTINCT ?work ?work_label ?image (COUNT(DISTINCT(?depict)) AS ?total) WHERE { SERVICE wikibase:label { bd:serviceParam wikibase:language 'pt-br,pt,en'. } BIND(wd:"+qid_instance+" AS ?instance) ?work wdt:P195 wd:Q56677470. {?work wdt:P18 ?image; wdt:P180 ?depict; wdt:P31 ?instance.} UNION {?work_ wdt:P31 ?instance. ?work wdt:P195 ?work_; wdt:P18 ?image; wdt:P180 ?depict.} ?work rdfs:label ?work_label. FILTER((LANG(?work_label)) = \""+lang+"\")} GROUP BY ?work ?work_label ?image ORDER BY ?total")
-    return data
+    data = catalog.works_of_instance(qid_instance, lang)
+    if data is not None:
+        return data
+    return query_template("works_of_instance", instance=qid_instance, lang=lang)
 
 
 def per_depict(lang="pt-br"):
-    data = query_wikidata("SELECT DISTINCT ?depict ?depict_label (COUNT(?work) AS ?total) WHERE { ?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depict. ?depict rdfs:label ?depict_label. FILTER((LANG(?depict_label)) = \""+lang+"\")} GROUP BY ?depict ?depict_label ORDER BY (?total)")
-    return data
+    return VIEWS.get("per_depict", lang)
 
 
-def works_of_depict(qid_depict, lang="pt-br"):
-    data = query_wikidata("SELECT DISTINCT ?work ?work_label ?image (COUNT(DISTINCT(?depict)) AS ?total) WHERE {BIND(wd:"+qid_depict+" AS ?depict_) ?work wdt:P195 wd:Q56677470. {?work wdt:P18 ?image; wdt:P180 ?depict; wdt:P180 ?depict_.} UNION {?work_ wdt:P180 ?depict_. ?work wdt:P195 ?work_; wdt:P18 ?image; wdt:P180 ?depict.} ?work rdfs:label ?work_label. FILTER((LANG(?work_label)) = \""+lang+"\")} GROUP BY ?work ?work_label ?image ORDER BY ?total")
-    return data
+def build_per_depict(lang):
+    data = catalog.per_depict(lang)
+    if data is not None:
+        return data
+    return query_template("per_depict", lang=lang)
+
 
+def works_of_depict(qid_depict, lang="pt-br"):
+    data = catalog.works_of_depict(qid_depict, lang)
+    if data is not None:
+        return data
+    return query_template("works_of_depict", depict=qid_depict, lang=lang)
 
-def work_data(qid_work, lang="pt-br", lang_fallback="pt"):
-    data = query_wikidata("SELECT DISTINCT ?work ?work_label_ ?date (SAMPLE(?image) AS ?image) (GROUP_CONCAT(DISTINCT(?instance);separator=';') AS ?instances) (GROUP_CONCAT(DISTINCT(?instance_label_);separator=';') AS ?instance_labels) (GROUP_CONCAT(DISTINCT(?creator);separator=';') AS ?creators) (GROUP_CONCAT(DISTINCT(?creator_label_);separator=';') AS ?creators_labels) (GROUP_CONCAT(DISTINCT(?material);separator=';') AS ?materials) (GROUP_CONCAT(DISTINCT(?material_label_);separator=';') AS ?materials_labels) (GROUP_CONCAT(DISTINCT(?commissioned);separator=';') AS ?commissioners) (GROUP_CONCAT(DISTINCT(?commissioned_label_);separator=';') AS ?commissioners_labels) WHERE {BIND(wd:"+qid_work+" AS ?work) ?work wdt:P18 ?image. OPTIONAL {?work wdt:P31 ?instance. OPTIONAL {?instance rdfs:label ?instance_label_ptbr. FILTER(LANG(?instance_label_ptbr)='"+lang+"')} OPTIONAL {?instance rdfs:label ?instance_label_pt. FILTER(LANG(?instance_label_pt)='"+lang_fallback+"')} BIND(IF(BOUND(?instance_label_ptbr),?instance_label_ptbr,IF(BOUND(?instance_label_pt),?instance_label_pt,'')) AS ?instance_label_)} OPTIONAL {?work wdt:P170 ?creator. OPTIONAL {?creator rdfs:label ?creator_label_ptbr. FILTER(LANG(?creator_label_ptbr)='"+lang+"')} OPTIONAL {?creator rdfs:label ?creator_label_pt. FILTER(LANG(?creator_label_pt)='"+lang_fallback+"')} BIND(IF(BOUND(?creator_label_ptbr),?creator_label_ptbr,IF(BOUND(?creator_label_pt),?creator_label_pt,'')) AS ?creator_label_)} OPTIONAL {?work wdt:P186 ?material. OPTIONAL {?material rdfs:label ?material_label_ptbr. FILTER(LANG(?material_label_ptbr)='"+lang+"')} OPTIONAL {?material rdfs:label ?material_label_pt. FILTER(LANG(?material_label_pt)='"+lang_fallback+"')} BIND(IF(BOUND(?material_label_ptbr),?material_label_ptbr,IF(BOUND(?material_label_pt),?material_label_pt,'')) AS ?material_label_)} OPTIONAL {?work wdt:P88 ?commissioned. OPTIONAL {?commissioned rdfs:label ?commissioned_label_ptbr. FILTER(LANG(?commissioned_label_ptbr)='"+lang+"')} OPTIONAL {?commissioned rdfs:label ?commissioned_label_pt. FILTER(LANG(?commissioned_label_pt)='"+lang_fallback+"')} BIND(IF(BOUND(?commissioned_label_ptbr),?commissioned_label_ptbr,IF(BOUND(?commissioned_label_pt),?commissioned_label_pt,'')) AS ?commissioned_label_)} OPTIONAL {?work rdfs:label ?work_label_ptbr. FILTER(LANG(?work_label_ptbr)='"+lang+"')} OPTIONAL {?work rdfs:label ?work_label_pt. FILTER(LANG(?work_label_pt)='"+lang_fallback+"')} BIND(IF(BOUND(?work_label_ptbr),?work_label_ptbr,IF(BOUND(?work_label_pt),?work_label_pt,'')) AS ?work_label_) OPTIONAL {?work p:P571/psv:P571 ?date_. ?date_ wikibase:timePrecision ?date_precision. ?date_ wikibase:timeValue ?date_value. BIND(IF(?date_precision=7,CONCAT('Século ',STR(YEAR(?date_value))),IF(?date_precision=8,CONCAT('Década de ',STR(YEAR(?date_value))),IF(?date_precision>8,STR(YEAR(?date_value)),''))) AS ?date)}} GROUP BY ?work ?work_label_ ?date")
-    return data
 
+def eligible_works():
+    catalog_ = catalog.get()
+    if catalog_ is not None:
+        works = catalog_.works.values()
+        return [work.qid for work in works], [work.qid for work in works if work.uncounted()]
 
-def work_depicts(qid_work, lang="pt-br", lang_fallback="pt"):
-    data = query_wikidata("SELECT DISTINCT ?depicts_ ?depicts ?depicts_label_ptbr ?depicts_desc_ptbr ?depicts_label_pt ?depicts_desc_pt ?quantity_ ?quantity  WHERE {BIND(wd:"+qid_work+" AS ?work) ?work p:P180 ?depicts_. ?depicts_ ps:P180 ?depicts. OPTIONAL {?depicts_ pq:P1114 ?quantity. ?depicts_ pqv:P1114 ?quantity_.} OPTIONAL {?depicts rdfs:label ?depicts_label_ptbr. FILTER((LANG(?depicts_label_ptbr)) = \""+lang+"\")} OPTIONAL {?depicts rdfs:label ?depicts_label_pt. FILTER((LANG(?depicts_label_pt)) = \""+lang_fallback+"\")} OPTIONAL {?depicts schema:description ?depicts_desc_ptbr. FILTER((LANG(?depicts_desc_ptbr)) = \""+lang+"\")} OPTIONAL {?depicts schema:description ?depicts_desc_pt. FILTER((LANG(?depicts_desc_pt)) = \""+lang_fallback+"\")}}")
-    return data
+    eligible = [row.work for row in query_template("eligible_works")]
+    if not DECK.prioritize:
+        return eligible, []
+    uncounted = [row.work for row in query_template("uncounted_works")]
+    return eligible, uncounted
 
 
 def get_next_qid(qid_from):
-    data = query_wikidata("SELECT DISTINCT ?work (MD5(CONCAT(str("+str(random())+"*RAND()),str(?work))) AS ?random_hash) WHERE {?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts. MINUS{VALUES ?work {wd:"+qid_from+"}}} ORDER BY ?random_hash LIMIT 1")
-    return data["results"]["bindings"][0]["work"]["value"].split("/")[-1]
+    qid = DECK.next(qid_from)
+    if qid:
+        return qid
+
+    return query_template("next_qid", exclude=qid_from, seed=random())[0].work
 
 
 def get_tutorial_collections():
-    data = query_wikidata("SELECT DISTINCT ?collection_label (COUNT(?work) AS ?total) WHERE {?work wdt:P195 wd:Q56677470. ?work wdt:P195 ?collection. ?work wdt:P18 ?image. ?work wdt:P180 ?depict. ?collection rdfs:label ?collection_label_. FILTER(LANG(?collection_label_)='pt-br') FILTER(?collection!=wd:Q56677470) BIND(SUBSTR(?collection_label_,8) AS ?collection_label)} GROUP BY ?collection_label ORDER BY ?total")
-    return data
+    return query_template("tutorial_collections")
 
 
 def get_tutorial_images():
-    data = query_wikidata("SELECT DISTINCT ?image (COUNT(?depict) AS ?total) WHERE {BIND(wd:Q56677463 AS ?collection) ?work wdt:P195 ?collection. ?work wdt:P18 ?image. ?work wdt:P180 ?depict. FILTER(?work!=wd:Q56730380)} GROUP BY ?image ORDER BY ?total LIMIT 20")
-    return data
+    return query_template("tutorial_images", collection="Q56677463", exclude="Q56730380")
 
 
-def get_tutorial_total_qids(sparql="."):
-    data = query_wikidata("SELECT DISTINCT (COUNT(?work) AS ?total) WHERE {?work wdt:P195 wd:Q56677470"+sparql+"}")
-    return data["results"]["bindings"][0]["total"]["value"]
+def get_tutorial_total_qids(collection=None):
+    if collection is None:
+        rows = query_template("tutorial_total")
+    else:
+        rows = query_template("tutorial_total_collection", collection=collection)
+    return rows[0].total
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Decoder of the results of the Wikidata Query Service. The results are
+# requested as CSV, the most compact format of the service, and parsed while
+# they are downloaded into lightweight rows, named tuples with a field per
+# column, where the entities are already QIDs and the images of Commons are
+# already file names. Unbound values are empty strings.
+
+import csv
+import io
+from collections import namedtuple
+
+ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+IMAGE_PREFIX = "http://commons.wikimedia.org/wiki/Special:FilePath/"
+MIMETYPE = "text/csv"
+_ROW_TYPES = {}
+
+
+def row_type(columns):
+    columns = tuple(columns)
+    if columns not in _ROW_TYPES:
+        _ROW_TYPES[columns] = namedtuple("Row", columns)
+    return _ROW_TYPES[columns]
+
+
+def compact(value):
+    # Statements (entity/statement/...) are kept as they are
+    if value.startswith(ENTITY_PREFIX) and "/" not in value[len(ENTITY_PREFIX):]:
+        return value[len(ENTITY_PREFIX):]
+    if value.startswith(IMAGE_PREFIX):
+        return value[len(IMAGE_PREFIX):]
+    return value
+
+
+def decode(lines):
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    row = row_type(header)
+    for values in reader:
+        yield row._make(compact(value) for value in values)
+
+
+def stream(response):
+    # Rows are decoded as the body arrives, without keeping it in memory
+    response.raw.decode_content = True
+    # The body is closed by the caller, not when the text wrapper reaches its end
+    response.raw.auto_close = False
+    yield from decode(io.TextIOWrapper(response.raw, encoding="utf-8", newline=""))
+
+
+def dump(rows):
+    # JSON form of a list of rows, to share it between processes
+    return {"columns": list(rows[0]._fields) if rows else [], "rows": [list(row) for row in rows]}
+
+
+def load(data):
+    if not data["rows"]:
+        return []
+    row = row_type(data["columns"])
+    return [row._make(values) for values in data["rows"]]
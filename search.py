@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Search of the labels of the descriptors, creators, types and collections of
+# the catalog. The index is built in memory from the bulk-loaded catalog every
+# time it changes: the prefixes of every word of every label, in all the
+# languages of the catalog, point to the entries, so a query is answered with
+# a few set intersections. Queries that are not the beginning of a word are
+# answered by an index of the trigrams of the labels.
+
+import heapq
+import re
+import unicodedata
+
+import catalog
+
+# Longest prefix of a word kept in the index; longer words of a query are
+# checked against the labels of the candidates
+MAX_PREFIX = 10
+WORD = re.compile(r"\w+")
+# Kind of entry -> (index of the catalog, excluded QIDs)
+KINDS = {
+    "depict": (lambda catalog_: catalog_.depicts_direct, ()),
+    "creator": (lambda catalog_: catalog_.by_creator, ()),
+    "instance": (lambda catalog_: catalog_.instances_direct, (catalog.EXCLUDED_INSTANCE,)),
+    "collection": (lambda catalog_: catalog_.by_collection, (catalog.ROOT_COLLECTION,)),
+}
+
+
+def normalize(text):
+    # Case and accents are ignored: "Fotografia" matches "fotografía"
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class Entry(object):
+    __slots__ = ("kind", "qid", "labels", "keys", "words", "total")
+
+    def __init__(self, kind, qid, labels, total):
+        self.kind = kind
+        self.qid = qid
+        self.labels = labels
+        self.keys = tuple(set(normalize(label) for label in labels.values()))
+        self.words = tuple(set(word for key in self.keys for word in WORD.findall(key)))
+        self.total = total
+
+    def label(self, lang):
+        if lang in self.labels:
+            return self.labels[lang]
+        for lang_ in catalog.LANGUAGES:
+            if lang_ in self.labels:
+                return self.labels[lang_]
+        return self.qid
+
+    def rank(self, text):
+        # Whole labels first, then labels that start with the query, then the most used entries
+        if text in self.keys:
+            return 0, -self.total
+        if any(key.startswith(text) for key in self.keys):
+            return 1, -self.total
+        return 2, -self.total
+
+
+class SearchIndex(object):
+    def __init__(self, entries):
+        self.entries = entries
+        self.prefixes = {}
+        self.trigrams = {}
+        for position, entry in enumerate(entries):
+            for word in entry.words:
+                for size in range(1, min(len(word), MAX_PREFIX) + 1):
+                    self.prefixes.setdefault(word[:size], set()).add(position)
+            for key in entry.keys:
+                for trigram in trigrams(key):
+                    self.trigrams.setdefault(trigram, set()).add(position)
+
+    def search(self, text, lang, kind=None, limit=10):
+        text = normalize(text).strip()
+        words = WORD.findall(text)
+        if not words:
+            return []
+
+        found = self._by_prefix(words)
+        if len(found) < limit and len(text) >= 3:
+            found.update(self._by_substring(text))
+
+        entries = [self.entries[position] for position in found]
+        if kind is not None:
+            entries = [entry for entry in entries if entry.kind == kind]
+        entries = heapq.nsmallest(limit, entries, key=lambda entry: entry.rank(text))
+        return [(entry.kind, entry.qid, entry.label(lang), entry.total) for entry in entries]
+
+    def _by_prefix(self, words):
+        found = None
+        for word in words:
+            candidates = self.prefixes.get(word[:MAX_PREFIX], set())
+            if len(word) > MAX_PREFIX:
+                candidates = set(position for position in candidates
+                                 if any(word_.startswith(word) for word_ in self.entries[position].words))
+            found = candidates if found is None else found & candidates
+            if not found:
+                return set()
+        return set(found)
+
+    def _by_substring(self, text):
+        found = None
+        for trigram in trigrams(text):
+            found = self.trigrams.get(trigram, set()) if found is None else found & self.trigrams.get(trigram, set())
+            if not found:
+                return set()
+        return set(position for position in found if any(text in key for key in self.entries[position].keys))
+
+
+INDEX = SearchIndex([])
+
+
+def build(catalog_):
+    entries = []
+    for kind, (index, excluded) in KINDS.items():
+        for qid, works in index(catalog_).items():
+            labels = catalog_.labels.get(qid)
+            if labels and qid not in excluded:
+                entries.append(Entry(kind, qid, labels, len(works)))
+    return SearchIndex(entries)
+
+
+def rebuild(catalog_):
+    global INDEX
+    INDEX = build(catalog_)
+    return INDEX
+
+
+def search(text, lang, kind=None, limit=10):
+    return INDEX.search(text, lang, kind, limit)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Serves the application on an event loop. The standard library is patched
+# by gevent before anything else is imported, so the blocking calls of
+# requests, requests_oauthlib and the worker threads of the application
+# become cooperative: a request waiting for Wikidata only holds a greenlet,
+# and one process keeps hundreds of upstream calls in flight.
+#
+#   python serve.py
+#   gunicorn -k gevent app:app   (same mode under gunicorn)
+#
+# In both cases the application finds the standard library patched when it is
+# imported, and sets itself up for this mode (see cooperative.py).
+
+from gevent import monkey
+
+monkey.patch_all()
+
+from gevent.pool import Pool  # noqa: E402
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+from app import app  # noqa: E402
+
+
+def main():
+    server = WSGIServer((app.config.get('SERVER_HOST', '127.0.0.1'), app.config.get('SERVER_PORT', 5000)), app,
+                        spawn=Pool(app.config.get('ASYNC_CONNECTIONS', 1000)))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Templates of the queries sent to the Wikidata Query Service. Each family
+# of queries is declared once, with the types of its parameters; binding the
+# parameters validates them and gives a canonical fingerprint of the query,
+# used as its cache key, and the text is only rendered when it is sent.
+
+import re
+from string import Template as StringTemplate
+
+QID_PATTERN = re.compile(r"^Q[1-9][0-9]*$")
+LANG_PATTERN = re.compile(r"^[a-z]{2,3}(-[a-z0-9]+)*$")
+TEMPLATES = {}
+
+
+class InvalidParameter(ValueError):
+    pass
+
+
+# Types of the parameters: each one validates a value and returns its
+# canonical form, safe to be put in the query
+def qid(value):
+    value = str(value).strip().upper()
+    if not QID_PATTERN.match(value):
+        raise InvalidParameter("Invalid QID: %r" % value)
+    return value
+
+
+def lang(value):
+    value = str(value).strip().lower() if value is not None else ""
+    if not LANG_PATTERN.match(value):
+        raise InvalidParameter("Invalid language code: %r" % value)
+    return value
+
+
+def text(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("'", "\\'").replace("\n", "\\n")
+
+
+def decade(value):
+    # A year ending in 0, or the label given to the works with no decade
+    try:
+        return str(int(value))
+    except (TypeError, ValueError):
+        return text(value)
+
+
+def number(value):
+    return repr(float(value))
+
+
+class Template(object):
+    __slots__ = ("name", "text", "params")
+
+    def __init__(self, name, text, params):
+        self.name = name
+        self.text = StringTemplate(" ".join(text.split()))
+        self.params = params
+
+    def bind(self, **values):
+        if set(values) != set(self.params):
+            raise InvalidParameter("%s takes %s, got %s" % (self.name, ", ".join(sorted(self.params)),
+                                                            ", ".join(sorted(values))))
+        return Query(self, {key: self.params[key](value) for key, value in values.items()})
+
+
+class Query(object):
+    __slots__ = ("template", "values", "fingerprint")
+
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+        self.fingerprint = "%s(%s)" % (template.name, ",".join("%s=%s" % item for item in sorted(values.items())))
+
+    @property
+    def family(self):
+        return self.template.name
+
+    def render(self):
+        return self.template.text.substitute(self.values)
+
+
+def template(name, text, **params):
+    TEMPLATES[name] = Template(name, text, params)
+
+
+def bind(name, **values):
+    return TEMPLATES[name].bind(**values)
+
+
+template("per_collection",
+         "SELECT ?collection ?collection_label (COUNT(?work) AS ?num_works) WHERE { "
+         "?work wdt:P195 wd:Q56677470. "
+         "?work wdt:P180 ?depicts. "
+         "?work wdt:P195 ?collection. "
+         "FILTER(?collection != wd:Q56677470). "
+         "?work wdt:P18 ?image. "
+         "?collection rdfs:label ?collection_label. "
+         "FILTER((LANG(?collection_label)) = \"$lang\") "
+         "} GROUP BY ?collection ?collection_label ORDER BY ?num_works",
+         lang=lang)
+
+template("works_in_collection",
+         "SELECT DISTINCT ?work ?image ?work_label (COUNT(DISTINCT (?depicts_p)) AS ?count_depicts) WHERE { "
+         "SERVICE wikibase:label { bd:serviceParam wikibase:language 'pt-br,pt,en'. ?work rdfs:label ?work_label} "
+         "?work wdt:P195 wd:$collection; "
+         "wdt:P180 ?depicts; "
+         "wdt:P18 ?image. "
+         "OPTIONAL {?work p:P180 ?depicts_p. "
+         "?depicts_p pq:P1114 ?depicts_quantity.} "
+         "} GROUP BY ?work ?image ?work_label ORDER BY (?count_depicts)",
+         collection=qid)
+
+template("collection_data",
+         "SELECT DISTINCT ?collection "
+         "?collection_category ?collection_article "
+         "?named_after ?named_after_article "
+         "(COUNT(?work) AS ?total) "
+         "(COUNT(?work_scope) AS ?total_scope) WHERE { "
+         "BIND(wd:$collection AS ?collection) "
+         "OPTIONAL {?commons_collection schema:about ?collection; "
+         "schema:name ?collection_category; "
+         "schema:isPartOf <https://commons.wikimedia.org/>.} "
+         "OPTIONAL {?article_collection schema:about ?collection; "
+         "schema:name ?collection_article; "
+         "schema:isPartOf <https://pt.wikipedia.org/>.} "
+         "OPTIONAL {?collection wdt:P138 ?named_after. "
+         "OPTIONAL{?article schema:about ?named_after; "
+         "schema:name ?named_after_article; "
+         "schema:isPartOf <https://pt.wikipedia.org/>.}} "
+         "?work wdt:P195 ?collection. "
+         "OPTIONAL {?work wdt:P18 ?image; "
+         "wdt:P180 ?depic. BIND(1 AS ?work_scope)} "
+         "} GROUP BY ?named_after ?named_after_article ?collection "
+         "?collection_category ?collection_article",
+         collection=qid)
+
+template("per_creator",
+         "SELECT DISTINCT ?creator ?creator_label (COUNT(?work) AS ?total) WHERE { "
+         "?work wdt:P195 wd:Q56677470. "
+         "{?work wdt:P18 ?image; wdt:P180 ?depict; wdt:P170 ?creator.} "
+         "UNION {?work_ wdt:P170 ?creator. ?work wdt:P195 ?work_; wdt:P18 ?image; wdt:P180 ?depict.} "
+         "?creator rdfs:label ?creator_label. "
+         "FILTER((LANG(?creator_label)) = '$lang') "
+         "} GROUP BY ?creator ?creator_label ORDER BY (?total)",
+         lang=lang)
+
+template("total_works",
+         "SELECT (COUNT(DISTINCT(?work)) AS ?number_works) WHERE { "
+         "?work wdt:P195 wd:Q56677470. "
+         "?work wdt:P180 ?depicts. "
+         "?work wdt:P18 ?image.}")
+
+template("works_of_creator",
+         "SELECT DISTINCT ?work ?work_label ?image (COUNT(?depict) AS ?total) WHERE { "
+         "BIND(wd:$creator AS ?creator) "
+         "?work rdfs:label ?work_label. "
+         "FILTER((LANG(?work_label)) = '$lang') "
+         "?work wdt:P195 wd:Q56677470. "
+         "{?work wdt:P18 ?image; "
+         "wdt:P180 ?depict; "
+         "wdt:P170 ?creator.} "
+         "UNION "
+         "{?work_ wdt:P170 ?creator. "
+         "?work wdt:P195 ?work_; "
+         "wdt:P18 ?image; "
+         "wdt:P180 ?depict.} "
+         "} GROUP BY ?work ?work_label ?image ORDER BY (?total)",
+         creator=qid, lang=lang)
+
+template("creator_data",
+         "SELECT DISTINCT ?creator_ ?creator_article "
+         "(COUNT(?work) AS ?total) "
+         "(COUNT(?work_scope) AS ?total_scope) WHERE { "
+         "BIND(wd:$creator AS ?creator_) "
+         "OPTIONAL {?article_ schema:about ?creator_; "
+         "schema:inLanguage 'pt'; "
+         "schema:name ?creator_article.} "
+         "?work wdt:P195 wd:Q56677470. "
+         "{?work wdt:P170 ?creator_} "
+         "UNION {?work_ wdt:P170 ?creator_. "
+         "?work wdt:P195 ?work_.} "
+         "OPTIONAL {?work wdt:P18 ?image; "
+         "wdt:P180 ?depict. "
+         "BIND(1 AS ?work_scope)} "
+         "} GROUP BY ?creator_ ?creator_article",
+         creator=qid)
+
+template("per_decade",
+         "SELECT DISTINCT ?decade WHERE { "
+         "?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts. "
+         "?work p:P571 ?decade_aux. ?decade_aux psv:P571 ?decade_. "
+         "?decade_ wikibase:timeValue ?value. ?decade_ wikibase:timePrecision ?precision. "
+         "BIND(IF(?precision = 7,CONCAT('$indeterminate'), STR(10*FLOOR(YEAR(?value)/10))) AS ?decade)"
+         "} ORDER BY ?decade",
+         indeterminate=text)
+
+template("works_of_decade",
+         "SELECT DISTINCT ?work ?work_label ?image (COUNT(?depicts) AS ?total) WHERE { "
+         "SERVICE wikibase:label { bd:serviceParam wikibase:language 'pt-br,pt,en'. } "
+         "?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts. "
+         "?work p:P571 ?decade_aux. ?decade_aux psv:P571 ?decade_. "
+         "?decade_ wikibase:timeValue ?value. ?decade_ wikibase:timePrecision ?precision. "
+         "?work rdfs:label ?work_label. FILTER((LANG(?work_label)) = \"$lang\") "
+         "BIND(IF(?precision = 7,CONCAT('$indeterminate'), STR(10*FLOOR(YEAR(?value)/10))) AS ?decade) "
+         "FILTER(?decade=\"$decade\")"
+         "} GROUP BY ?work ?work_label ?image ORDER BY ?total",
+         decade=decade, lang=lang, indeterminate=text)
+
+template("per_instance",
+         "SELECT DISTINCT ?instance ?instance_label (COUNT(DISTINCT(?work)) AS ?total) WHERE { "
+         "?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts; wdt:P31 ?instance. "
+         "?instance rdfs:label ?instance_label. FILTER(LANG(?instance_label)=\"$lang\") "
+         "FILTER(?instance!=wd:Q18593264)"
+         "} GROUP BY ?instance ?instance_label ORDER BY ?total",
+         lang=lang)
+
+template("works_of_instance",
+         "SELECT DISTINCT ?work ?work_label ?image (COUNT(DISTINCT(?depict)) AS ?total) WHERE { "
+         "SERVICE wikibase:label { bd:serviceParam wikibase:language 'pt-br,pt,en'. } "
+         "BIND(wd:$instance AS ?instance) "
+         "?work wdt:P195 wd:Q56677470. "
+         "{?work wdt:P18 ?image; wdt:P180 ?depict; wdt:P31 ?instance.} "
+         "UNION {?work_ wdt:P31 ?instance. ?work wdt:P195 ?work_; wdt:P18 ?image; wdt:P180 ?depict.} "
+         "?work rdfs:label ?work_label. FILTER((LANG(?work_label)) = \"$lang\")"
+         "} GROUP BY ?work ?work_label ?image ORDER BY ?total",
+         instance=qid, lang=lang)
+
+template("per_depict",
+         "SELECT DISTINCT ?depict ?depict_label (COUNT(?work) AS ?total) WHERE { "
+         "?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depict. "
+         "?depict rdfs:label ?depict_label. FILTER((LANG(?depict_label)) = \"$lang\")"
+         "} GROUP BY ?depict ?depict_label ORDER BY (?total)",
+         lang=lang)
+
+template("works_of_depict",
+         "SELECT DISTINCT ?work ?work_label ?image (COUNT(DISTINCT(?depict)) AS ?total) WHERE { "
+         "BIND(wd:$depict AS ?depict_) "
+         "?work wdt:P195 wd:Q56677470. "
+         "{?work wdt:P18 ?image; wdt:P180 ?depict; wdt:P180 ?depict_.} "
+         "UNION {?work_ wdt:P180 ?depict_. ?work wdt:P195 ?work_; wdt:P18 ?image; wdt:P180 ?depict.} "
+         "?work rdfs:label ?work_label. FILTER((LANG(?work_label)) = \"$lang\")"
+         "} GROUP BY ?work ?work_label ?image ORDER BY ?total",
+         depict=qid, lang=lang)
+
+template("eligible_works",
+         "SELECT DISTINCT ?work WHERE {?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts.}")
+
+template("uncounted_works",
+         "SELECT DISTINCT ?work WHERE {?work wdt:P195 wd:Q56677470; wdt:P18 ?image; p:P180 ?depicts_. "
+         "FILTER NOT EXISTS {?depicts_ pq:P1114 ?quantity.}}")
+
+template("next_qid",
+         "SELECT DISTINCT ?work (MD5(CONCAT(str($seed*RAND()),str(?work))) AS ?random_hash) WHERE { "
+         "?work wdt:P195 wd:Q56677470; wdt:P18 ?image; wdt:P180 ?depicts. "
+         "MINUS{VALUES ?work {wd:$exclude}}"
+         "} ORDER BY ?random_hash LIMIT 1",
+         exclude=qid, seed=number)
+
+template("tutorial_collections",
+         "SELECT DISTINCT ?collection_label (COUNT(?work) AS ?total) WHERE { "
+         "?work wdt:P195 wd:Q56677470. ?work wdt:P195 ?collection. ?work wdt:P18 ?image. ?work wdt:P180 ?depict. "
+         "?collection rdfs:label ?collection_label_. FILTER(LANG(?collection_label_)='pt-br') "
+         "FILTER(?collection!=wd:Q56677470) BIND(SUBSTR(?collection_label_,8) AS ?collection_label)"
+         "} GROUP BY ?collection_label ORDER BY ?total")
+
+template("tutorial_images",
+         "SELECT DISTINCT ?image (COUNT(?depict) AS ?total) WHERE { "
+         "BIND(wd:$collection AS ?collection) ?work wdt:P195 ?collection. ?work wdt:P18 ?image. "
+         "?work wdt:P180 ?depict. FILTER(?work!=wd:$exclude)"
+         "} GROUP BY ?image ORDER BY ?total LIMIT 20",
+         collection=qid, exclude=qid)
+
+template("tutorial_total",
+         "SELECT DISTINCT (COUNT(?work) AS ?total) WHERE {?work wdt:P195 wd:Q56677470.}")
+
+template("tutorial_total_collection",
+         "SELECT DISTINCT (COUNT(?work) AS ?total) WHERE {?work wdt:P195 wd:Q56677470; wdt:P195 wd:$collection.}",
+         collection=qid)
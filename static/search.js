@@ -0,0 +1,26 @@
+// Suggestions of the search box of the listing pages, from /api/search
+$(function () {
+    var box = $('#search_box');
+    var list = $('#search_results');
+    var pending = null;
+
+    box.on('input', function () {
+        var text = box.val().trim();
+        clearTimeout(pending);
+        if (!text) {
+            list.empty();
+            return;
+        }
+        pending = setTimeout(function () {
+            $.getJSON(box.data('url'), {q: text, kind: box.data('kind')}, function (data) {
+                if (box.val().trim() !== text) {
+                    return;
+                }
+                list.empty();
+                $.each(data.results, function (i, result) {
+                    list.append($('<li>').append($('<a tabindex="0">').attr('href', result.url).text(result.label)));
+                });
+            });
+        }, 100);
+    });
+});
@@ -0,0 +1,81 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import catalog
+import coalesce
+import edit_queue
+import query
+import throttle
+import views
+import wikidata_oauth
+
+
+class StandIn(BaseHTTPRequestHandler):
+    def do_GET(self):
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        self.reply(self.server.api(params), "application/json", json.dumps)
+
+    def do_POST(self):
+        form = dict(parse_qsl(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")))
+        if urlsplit(self.path).path != "/sparql":
+            # Edits signed by the user
+            self.server.edits.append(form)
+            self.reply(self.server.api(form), "application/json", json.dumps)
+            return
+        with self.server.lock:
+            self.server.posts += 1
+        answer = self.server.sparql(form.get("query", ""))
+        status, headers, body = answer if isinstance(answer, tuple) else (200, {}, answer)
+        self.reply(body, "text/csv", str, status, headers)
+
+    def reply(self, body, mimetype, encode, status=200, headers=None):
+        body = encode(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", mimetype)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.lock = threading.Lock()
+    server.posts = 0
+    server.edits = []
+    # The query service answers the CSV of a query, or (status, headers, body);
+    # by default no work entered the collection
+    server.sparql = lambda query: "work\r\n"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:%d" % server.server_address[1]
+    monkeypatch.setattr(query, "WIKIDATA_API_ENDPOINT", base + "/w/api.php")
+    monkeypatch.setattr(query, "SPARQL_ENDPOINT", base + "/sparql")
+    monkeypatch.setattr(wikidata_oauth, "WIKIDATA_API_ENDPOINT", base + "/w/api.php")
+    monkeypatch.setitem(throttle.SETTINGS, "WDQS_LIMITER_PATH", str(tmp_path / "wdqs.limiter"))
+    monkeypatch.setitem(coalesce.SETTINGS, "COALESCE_DIR", str(tmp_path / "flights"))
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(scope="session")
+def povoconta():
+    # The app module, imported without its background threads
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(catalog, "start", lambda *args, **kwargs: None)
+        patch.setattr(views.MaterializedViews, "start", lambda *args, **kwargs: None)
+        patch.setattr(edit_queue.EditQueue, "start", lambda *args, **kwargs: [])
+        import app
+    return app
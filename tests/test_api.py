@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Errors of the JSON API, answered in JSON with their status.
+
+import pytest
+
+import catalog
+import throttle
+
+
+@pytest.fixture
+def client(povoconta, monkeypatch):
+    # Without a catalog, the listings are asked to the query service
+    monkeypatch.setattr(catalog, "_CATALOG", None)
+    return povoconta.app.test_client()
+
+
+def test_unknown_facet(client):
+    response = client.get("/api/shelf/Q1")
+    assert response.status_code == 404
+    assert response.get_json()["status"] == 404
+
+
+def test_unknown_kind_of_search(client):
+    response = client.get("/api/search?q=cadeira&kind=shelf")
+    assert response.status_code == 400
+    assert response.get_json()["status"] == 400
+
+
+def test_failure_of_the_query_service(client, stand_in):
+    stand_in.sparql = lambda query: (400, {}, "Query is malformed")
+    response = client.get("/api/collection/Q1")
+    assert response.status_code == 502
+    assert response.get_json()["status"] == 502
+
+
+def test_throttled(client, stand_in, monkeypatch):
+    def throttled(*args, **kwargs):
+        raise throttle.Throttled(2)
+
+    monkeypatch.setattr(throttle, "acquire", throttled)
+    response = client.get("/api/collection/Q1")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+    assert response.get_json()["status"] == 503
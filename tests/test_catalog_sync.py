@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Incremental sync of the catalog against a local stand-in of the Wikidata
+# API and of the Wikidata Query Service.
+
+import pytest
+
+import catalog
+import query
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    work = catalog.Work("Q1", "a.jpg", 10)
+    work.collections = (catalog.ROOT_COLLECTION,)
+    work.depicts = (("Q1$a", "Q2", None),)
+    catalog_ = catalog.Catalog({"Q1": work}, {}, {"Q1": {"pt-br": "Obra"}}, {})
+    monkeypatch.setattr(catalog, "_CATALOG", catalog_)
+    return catalog_
+
+
+def test_error_reply_leaves_the_catalog_unchanged(stand_in, loaded):
+    stand_in.api = lambda params: {"error": {"code": "maxlag", "info": "Waiting for a server"}}
+    with pytest.raises(query.ApiError):
+        catalog.sync()
+    assert catalog.get() is loaded
+    assert list(catalog.get().works) == ["Q1"]
+
+
+def test_absent_works_are_kept(stand_in, loaded):
+    stand_in.api = lambda params: {"entities": {}}
+    assert catalog.sync() is loaded
+
+
+def test_deleted_works_are_dropped(stand_in, loaded):
+    stand_in.api = lambda params: {"entities": {"Q1": {"id": "Q1", "missing": ""}}}
+    assert catalog.sync().works == {}
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Deadlines of the callers waiting for an identical call in flight.
+
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+import coalesce
+
+
+@pytest.fixture(autouse=True)
+def flights(tmp_path, monkeypatch):
+    monkeypatch.setitem(coalesce.SETTINGS, "COALESCE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_waits_for_the_call_in_flight():
+    release = threading.Event()
+    leader = threading.Thread(target=coalesce.run, args=("key", lambda: release.wait(5) and "shared"))
+    leader.start()
+    time.sleep(0.1)
+    threading.Timer(0.1, release.set).start()
+    assert coalesce.run("key", lambda: "own", deadline=5) == "shared"
+    leader.join()
+
+
+def test_does_not_wait_past_its_deadline_in_the_process():
+    release = threading.Event()
+    leader = threading.Thread(target=coalesce.run, args=("key", lambda: release.wait(5)))
+    leader.start()
+    time.sleep(0.1)
+    started = time.time()
+    assert coalesce.run("key", lambda: "own", deadline=0.2) == "own"
+    assert time.time() - started < 1
+    release.set()
+    leader.join()
+
+
+def test_does_not_wait_past_its_deadline_across_processes(flights):
+    path = os.path.join(str(flights), hashlib.sha1(b"key").hexdigest())
+    with open(path, "a+") as file:
+        # The lock of a call in flight in another process
+        fcntl.flock(file, fcntl.LOCK_EX)
+        started = time.time()
+        assert coalesce.run("key", lambda: "own", deadline=0.2) == "own"
+        assert time.time() - started < 1
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Edits of a process that stopped, queued again by the next process.
+
+import sqlite3
+
+import pytest
+
+import edit_queue
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    # The heartbeat of a process is stale as soon as another one beats
+    monkeypatch.setattr(edit_queue, "ORPHAN_AFTER", 0)
+    return str(tmp_path / "edits.sqlite3")
+
+
+def test_lost_credentials_are_replaced_by_the_next_save(journal):
+    sent = []
+    stopped = edit_queue.EditQueue(journal, lambda qid, quantities, credentials: None)
+    lost = stopped.enqueue("Ana", ("old", "secret"), "Q1", {"Q1$a": 2})
+
+    restarted = edit_queue.EditQueue(journal, lambda qid, quantities, credentials: sent.append((qid, credentials)))
+    assert restarted.status("Ana")["failures"][0]["error"] == edit_queue.LOGIN_AGAIN
+
+    restarted.enqueue("Ana", ("new", "secret"), "Q2", {"Q2$a": 1})
+    while True:
+        row = restarted.claim()
+        if row is None:
+            break
+        restarted.process(row)
+    assert sorted(sent) == [("Q1", ("new", "secret")), ("Q2", ("new", "secret"))]
+    assert restarted.status("Ana")["done"] == 2
+    assert restarted.credentials == {}
+    assert lost in [id_ for id_, in sqlite3.connect(journal).execute("SELECT id FROM edits WHERE status = 'done'")]
+
+
+def test_only_the_edits_of_the_user_are_resumed(journal):
+    stopped = edit_queue.EditQueue(journal, lambda qid, quantities, credentials: None)
+    stopped.enqueue("Ana", ("ana", "secret"), "Q1", {"Q1$a": 2})
+
+    restarted = edit_queue.EditQueue(journal, lambda qid, quantities, credentials: None)
+    assert restarted.resume("Bia", ("bia", "secret")) == 0
+    assert restarted.resume("Ana", ("ana", "secret")) == 1
+    assert restarted.status("Ana")["pending"] == 1
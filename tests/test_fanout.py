@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Deadline of the parallel upstream calls of a route.
+
+import threading
+
+import pytest
+
+import fanout
+
+
+def test_late_calls_take_their_default():
+    release = threading.Event()
+    results = fanout.gather({"works": (lambda: ["Q1"],), "label": (release.wait, 5)}, 0.2, {"label": "Q2"})
+    release.set()
+    assert results == {"works": ["Q1"], "label": "Q2"}
+
+
+def test_late_calls_without_default_fail_the_route():
+    release = threading.Event()
+    with pytest.raises(fanout.DeadlineExceeded) as error:
+        fanout.gather({"works": (release.wait, 5), "label": (lambda: "Q2",)}, 0.2, {"label": "Q2"})
+    release.set()
+    assert error.value.names == ["works"]
+    assert error.value.results == {"label": "Q2"}
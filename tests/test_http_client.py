@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Retries of the calls to a local stand-in of the Wikidata Query Service.
+
+import time
+
+import pytest
+import requests
+
+import http_client
+import query
+import throttle
+
+
+@pytest.fixture
+def short_timeout(monkeypatch):
+    monkeypatch.setitem(http_client.SETTINGS, "HTTP_READ_TIMEOUT", 0.2)
+
+
+def test_read_timeout_is_not_retried(stand_in, short_timeout):
+    stand_in.sparql = lambda query_: time.sleep(0.5) or "work\r\n"
+    with pytest.raises(requests.ConnectionError):
+        list(query.stream_wikidata("SELECT ?work {}", priority=throttle.BACKGROUND))
+    assert stand_in.posts == 1
+
+
+def test_server_errors_are_retried(stand_in):
+    answers = [(502, {}, ""), "work\r\nhttp://www.wikidata.org/entity/Q1\r\n"]
+    stand_in.sparql = lambda query_: answers.pop(0)
+    rows = list(query.stream_wikidata("SELECT ?work {}", priority=throttle.BACKGROUND))
+    assert [row.work for row in rows] == ["Q1"]
+    assert stand_in.posts == 2
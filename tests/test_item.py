@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Item page built from the entity document of a local stand-in of the
+# Wikidata API.
+
+import pytest
+
+import labels
+import query
+
+
+def snak(value, type_="wikibase-entityid"):
+    return {"mainsnak": {"snaktype": "value", "datavalue": {"value": value, "type": type_}}, "rank": "normal"}
+
+
+def item(qid):
+    return snak({"entity-type": "item", "id": qid})
+
+
+def date(time, precision):
+    return [{"time": time, "precision": precision}]
+
+
+@pytest.mark.parametrize("values, formatted", [
+    (date("+1850-00-00T00:00:00Z", 7), "Século XIX"),
+    (date("+1890-00-00T00:00:00Z", 8), "Década de 1890"),
+    (date("+1895-00-00T00:00:00Z", 9), "1895"),
+    (date("+1895-04-12T00:00:00Z", 11), "1895"),
+    (date("-0450-00-00T00:00:00Z", 7), "Século V a.C."),
+    (date("-0450-00-00T00:00:00Z", 9), "-450"),
+    (date("+1000-00-00T00:00:00Z", 6), ""),
+    ([], ""),
+])
+def test_format_date(values, formatted):
+    assert query.format_date(values) == formatted
+
+
+@pytest.fixture
+def wikidata(stand_in, monkeypatch):
+    monkeypatch.setattr(labels, "STORE", labels.LabelStore())
+    documents = {
+        "Q1": {"id": "Q1", "claims": {
+            "P18": [snak("Quadro (1895).jpg", "string")],
+            "P170": [item("Q10")],
+            "P571": [snak(date("+1895-00-00T00:00:00Z", 9)[0], "time")],
+            "P180": [dict(item("Q20"), id="Q1$a",
+                          qualifiers={"P1114": [{"hash": "h1", "datavalue": {"value": {"amount": "+3"}}}]}),
+                     dict(item("Q21"), id="Q1$b"),
+                     {"id": "Q1$c", "mainsnak": {"snaktype": "somevalue"}}],
+        }},
+        "Q2": {"id": "Q2", "claims": {"P180": [dict(item("Q20"), id="Q2$a")]}},
+        "Q3": {"id": "Q3", "missing": ""},
+    }
+    names = {
+        "Q1": {"labels": {"pt-br": {"value": "Quadro"}}},
+        "Q10": {"labels": {"pt": {"value": "Pintor"}}},
+        "Q20": {"labels": {"pt": {"value": "cadeira"}}, "descriptions": {"pt": {"value": "móvel"}}},
+    }
+
+    def api(params):
+        if params["props"] == "labels|descriptions":
+            return {"entities": dict((qid, dict(names.get(qid, {"missing": ""}), id=qid))
+                                     for qid in params["ids"].split("|"))}
+        return {"entities": dict((qid, documents[qid]) for qid in params["ids"].split("|"))}
+
+    stand_in.api = api
+    return stand_in
+
+
+def test_item(wikidata):
+    work = query.fetch_item("Q1", "pt")
+    assert work["work_label"] == "Quadro"
+    assert work["image"] == "Quadro%20%281895%29.jpg"
+    assert work["date"] == "1895"
+    assert work["creators"] == [{"qid": "Q10", "label": "Pintor"}]
+    assert work["instances"] == []
+    assert [(depict["depict_id"], depict["depict_label"], depict["depict_desc"], depict["quantity_value"],
+             depict["quantity_hash"]) for depict in work["depicts"]] == [
+        ("Q1$a", "cadeira", "móvel", 3, "h1"),
+        # Without a label, the QID is shown
+        ("Q1$b", "Q21", "", 0, ""),
+    ]
+
+
+def test_work_without_image(wikidata):
+    assert query.fetch_item("Q2", "pt") is None
+
+
+def test_missing_work(wikidata):
+    assert query.fetch_item("Q3", "pt") is None
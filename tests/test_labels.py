@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Labels fetched on demand from a local stand-in of the Wikidata API.
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import labels
+import query
+import throttle
+
+
+def test_imported_on_its_own():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", "import labels"], cwd=root, check=True)
+
+
+def test_error_reply_is_not_kept(stand_in):
+    store = labels.LabelStore()
+    stand_in.api = lambda params: {"error": {"code": "ratelimited", "info": "Too many requests"}}
+    with pytest.raises(query.ApiError):
+        store.names(["Q5"], "pt-br")
+    assert store.fetched == {}
+
+    stand_in.api = lambda params: {"entities": {"Q5": {"id": "Q5", "labels": {"pt": {"value": "ser humano"}}}}}
+    assert store.names(["Q5"], "pt-br") == {"Q5": ("ser humano", "")}
+
+
+def test_only_answered_entities_are_kept(stand_in):
+    store = labels.LabelStore()
+    stand_in.api = lambda params: {"entities": {"Q6": {"id": "Q6", "missing": ""}}}
+    assert store.names(["Q5", "Q6"], "pt-br") == {"Q5": ("Q5", ""), "Q6": ("Q6", "")}
+    assert sorted(store.fetched) == ["Q6"]
+
+
+def test_name_of_a_failed_fetch(stand_in, monkeypatch):
+    monkeypatch.setattr(labels, "STORE", labels.LabelStore())
+    stand_in.api = lambda params: {"error": {"code": "maxlag", "info": "Waiting for replicas"}}
+    assert query.get_name("Q5") == ""
+
+    def throttled(*args, **kwargs):
+        raise throttle.Throttled(2)
+
+    monkeypatch.setattr(query, "wbgetentities", throttled)
+    with pytest.raises(throttle.Throttled):
+        query.get_name("Q5")
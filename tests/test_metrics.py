@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Export of the metrics in the Prometheus text format.
+
+import metrics
+
+
+def test_successful_and_failed_calls_are_rendered_together(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", metrics.Registry())
+    metrics.record("wdqs", "per_collection", 0.2, 200, 100)
+    metrics.record("wdqs", "per_collection", 0.1, "error", 0)
+    text = metrics.REGISTRY.render()
+    assert 'status="200"' in text
+    assert 'status="error"' in text
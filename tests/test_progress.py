@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Progress of the counting, kept from the catalog and the saved edits.
+
+import catalog
+import progress
+
+
+def work(qid, collections, creators, depicts):
+    work_ = catalog.Work(qid, "Image.jpg")
+    work_.collections = collections
+    work_.creators = creators
+    work_.depicts = depicts
+    return work_
+
+
+def collection():
+    works = {"Q1": work("Q1", ("Q10",), ("Q20",), (("Q1$a", "Q30", None), ("Q1$b", "Q31", 2))),
+             "Q2": work("Q2", ("Q11",), (), (("Q2$a", "Q30", None), ("Q2$b", "Q30", None)))}
+    # Every work of the collection Q11 is by Q21
+    return catalog.Catalog(works, {"Q11": {"P170": {"Q21"}}}, {}, {})
+
+
+def test_creators_of_the_collections():
+    tracker = progress.ProgressTracker()
+    catalog_ = collection()
+    tracker.load(catalog_)
+    creators = dict(tracker.breakdown("creator"))
+    assert sorted(creators) == sorted(catalog_.by_creator) == ["Q20", "Q21"]
+    assert creators["Q21"] == [2, 0, 1, 0]
+
+
+def test_breakdown_follows_the_edits():
+    tracker = progress.ProgressTracker()
+    tracker.load(collection())
+    assert tracker.breakdown("depict") == [("Q30", [3, 0, 2, 0]), ("Q31", [1, 1, 1, 1])]
+    assert tracker.breakdown("collection", 1) == [("Q11", [2, 0, 1, 0])]
+
+    tracker.record("Q2", {"Q2$a": 1, "Q2$b": 3})
+    assert tracker.breakdown("collection") == [("Q10", [2, 1, 1, 0]), ("Q11", [2, 2, 1, 1])]
+    assert tracker.breakdown("depict") == [("Q30", [3, 2, 2, 1]), ("Q31", [1, 1, 1, 1])]
+    assert tracker.total() == [4, 3, 2, 1]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Decoding of the CSV results of the Wikidata Query Service.
+
+import pytest
+
+import query
+import results
+import throttle
+
+
+@pytest.mark.parametrize("value, compacted", [
+    ("http://www.wikidata.org/entity/Q56677470", "Q56677470"),
+    # Statements keep their IRI
+    ("http://www.wikidata.org/entity/statement/Q1-abc", "http://www.wikidata.org/entity/statement/Q1-abc"),
+    ("http://commons.wikimedia.org/wiki/Special:FilePath/Quadro%20%281895%29.jpg", "Quadro%20%281895%29.jpg"),
+    ("https://www.wikidata.org/wiki/Q1", "https://www.wikidata.org/wiki/Q1"),
+    ("Década de 1890", "Década de 1890"),
+    ("", ""),
+])
+def test_compact(value, compacted):
+    assert results.compact(value) == compacted
+
+
+def test_decode():
+    rows = list(results.decode([
+        "work,work_label,image,total\r\n",
+        "http://www.wikidata.org/entity/Q1,\"Quadro, óleo\",http://commons.wikimedia.org/wiki/Special:FilePath/a.jpg,3\r\n",
+        "http://www.wikidata.org/entity/Q2,,,\r\n",
+    ]))
+    assert rows == [("Q1", "Quadro, óleo", "a.jpg", "3"), ("Q2", "", "", "")]
+    assert rows[0].work_label == "Quadro, óleo"
+    assert type(rows[0]) is results.row_type(["work", "work_label", "image", "total"])
+
+
+def test_decode_empty():
+    assert list(results.decode([])) == []
+    assert list(results.decode(["work\r\n"])) == []
+
+
+def test_dump_and_load():
+    rows = list(results.decode(["work,total\r\n", "http://www.wikidata.org/entity/Q1,3\r\n"]))
+    assert results.load(results.dump(rows)) == rows
+    assert results.load(results.dump([])) == []
+
+
+def test_stream(stand_in):
+    # A label with a line break, split across the chunks of the body
+    stand_in.sparql = lambda query_: ("work,work_label\r\n" + "".join(
+        "http://www.wikidata.org/entity/Q%d,\"Obra\r\n%d\"\r\n" % (i, i) for i in range(1, 2001)))
+    rows = list(query.stream_wikidata("SELECT ?work ?work_label {}", priority=throttle.BACKGROUND))
+    assert len(rows) == 2000
+    assert rows[-1] == ("Q2000", "Obra\r\n2000")
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Work shown after a save.
+
+import pytest
+
+
+@pytest.fixture
+def client(povoconta, monkeypatch):
+    monkeypatch.setattr(povoconta, "get_next_qid", lambda qid: "Q9")
+    return povoconta.app.test_client()
+
+
+def test_goes_to_the_prefetched_work(client):
+    response = client.post("/save/Q1/pt", data={"Q1$a;": "2", "next": "Q7"})
+    assert response.status_code == 302
+    assert "/qid/Q7/pt?" in response.location
+
+
+@pytest.mark.parametrize("next_qid", ["", "Q1", "https://example.org/", "Q7/../../logout", "Q7\n"])
+def test_invalid_work_is_replaced(client, next_qid):
+    response = client.post("/save/Q1/pt", data={"Q1$a;": "2", "next": next_qid})
+    assert "/qid/Q9/pt?" in response.location
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Quantities saved to a local stand-in of the Wikidata API in a single edit.
+
+import json
+
+import pytest
+
+
+def quantity(amount):
+    return {"snaktype": "value", "property": "P1114",
+            "datavalue": {"value": {"amount": amount, "unit": "1"}, "type": "quantity"}}
+
+
+def statement(id_, qualifiers=None, order=None):
+    statement_ = {"id": id_, "mainsnak": {"snaktype": "value", "property": "P180"}, "type": "statement"}
+    if qualifiers is not None:
+        statement_["qualifiers"] = qualifiers
+        statement_["qualifiers-order"] = order
+    return statement_
+
+
+@pytest.fixture
+def wikidata(stand_in, povoconta):
+    entity = {"id": "Q1", "lastrevid": 1234, "claims": {"P180": [
+        statement("Q1$counted", {"P1114": [quantity("+2")]}, ["P1114"]),
+        statement("Q1$new"),
+        statement("Q1$other", {"P2": [{"snaktype": "somevalue", "property": "P2"}]}, ["P2"]),
+        statement("Q1$untouched"),
+    ]}}
+
+    def api(params):
+        if params.get("meta") == "tokens":
+            return {"query": {"tokens": {"csrftoken": "token+\\"}}}
+        if params["action"] == "wbgetentities":
+            return {"entities": {"Q1": entity}}
+        return {"success": 1}
+
+    stand_in.api = api
+    with povoconta.app.app_context():
+        yield stand_in
+
+
+def test_only_changed_statements_are_saved(wikidata, povoconta):
+    povoconta.set_quantities("Q1", {"Q1$counted": 2, "Q1$new": 3, "Q1$other": 1}, ("key", "secret"))
+    [edit] = wikidata.edits
+    assert edit["action"] == "wbeditentity"
+    assert edit["baserevid"] == "1234"
+    assert edit["token"] == "token+\\"
+    claims = dict((claim["id"], claim) for claim in json.loads(edit["data"])["claims"])
+    assert sorted(claims) == ["Q1$new", "Q1$other"]
+    assert claims["Q1$new"]["qualifiers"]["P1114"] == [quantity("+3")]
+    assert claims["Q1$new"]["qualifiers-order"] == ["P1114"]
+    # The other qualifiers of the statement are kept
+    assert sorted(claims["Q1$other"]["qualifiers"]) == ["P1114", "P2"]
+    assert claims["Q1$other"]["qualifiers-order"] == ["P2", "P1114"]
+
+
+def test_nothing_is_saved_without_changes(wikidata, povoconta):
+    assert povoconta.set_quantities("Q1", {"Q1$counted": 2}, ("key", "secret")) is None
+    assert wikidata.edits == []
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Answers 429 of the Wikidata Query Service, from a local stand-in.
+
+import json
+
+import pytest
+import requests
+
+import query
+import throttle
+
+
+def test_429_is_not_retried_and_pauses_the_workers(stand_in):
+    stand_in.sparql = lambda query_: (429, {"Retry-After": "5"}, "")
+    with pytest.raises(requests.HTTPError):
+        list(query.stream_wikidata("SELECT ?work {}", priority=throttle.BACKGROUND))
+    assert stand_in.posts == 1
+    with open(throttle.SETTINGS["WDQS_LIMITER_PATH"]) as file:
+        state = json.load(file)
+    assert state["paused_until"] > state["refilled"] + 4
+    assert state["leases"] == {}
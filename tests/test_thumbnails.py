@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Size and downloads of the on-disk cache of the images.
+
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import coalesce
+import thumbnails
+
+
+class Response(object):
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setitem(coalesce.SETTINGS, "COALESCE_DIR", str(tmp_path / "flights"))
+    return thumbnails.ThumbnailCache(str(tmp_path / "thumbnails"))
+
+
+def test_size_of_files_written_again(cache):
+    path = cache.source_path("a.jpg")
+    cache.write(path, b"x" * 100)
+    cache.write(path, b"x" * 60)
+    assert cache.size == 60
+
+
+def test_cold_requests_download_the_file_once(cache, monkeypatch):
+    output = io.BytesIO()
+    Image.new("RGB", (800, 600)).save(output, "JPEG")
+    downloads = []
+
+    def get(url, **kwargs):
+        downloads.append(url)
+        time.sleep(0.2)
+        return Response(output.getvalue())
+
+    monkeypatch.setattr(thumbnails.http_client, "get", get)
+    threads = [threading.Thread(target=cache.get, args=("a.jpg", width)) for width in thumbnails.WIDTHS]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(downloads) == 1
+    assert all(cache.get("a.jpg", width)[1] == "image/jpeg" for width in thumbnails.WIDTHS)
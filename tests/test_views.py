@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Snapshots of the precomputed facet views.
+
+from collections import namedtuple
+
+import query
+import views
+
+Row = namedtuple("Row", ("collection", "collection_label", "num_works"))
+
+
+def test_requests_do_not_build_the_views():
+    built = []
+    views_ = views.MaterializedViews()
+    views_.define("per_collection", lambda lang: built.append(lang) or [lang], ["pt-br"])
+    assert views_.get("per_collection", "pt-br") is None
+    assert built == []
+
+    views_.refresh()
+    assert views_.get("per_collection", "pt-br") == ["pt-br"]
+    assert views_.get("per_collection", "en") is None
+    assert built == ["pt-br"]
+
+
+def test_unlisted_languages_read_the_default_views(povoconta, monkeypatch):
+    row = Row(collection="Q1", collection_label="Coleção Paulista", num_works=3)
+    monkeypatch.setattr(query.VIEWS, "snapshot", views.Snapshot(1, {("per_collection", "pt"): [row]}))
+    client = povoconta.app.test_client()
+
+    response = client.get("/p195", headers={"Accept-Language": "de"})
+    assert "Coleção Paulista" in response.get_data(as_text=True)
+
+    client.get("/set_locale?lang=de&return_to=/p195")
+    response = client.get("/p195")
+    assert "Coleção Paulista" in response.get_data(as_text=True)
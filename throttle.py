@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Rate limiter of the queries to the Wikidata Query Service, shared by all the
+# worker processes of the host. Its state, a token bucket, the slots of the
+# queries in flight and the callers waiting for one, is kept in a small file
+# that is read and written under an exclusive lock. A query waits for a token
+# and a slot until its deadline; the queries made by a request of a user go
+# before the ones of the background threads, and when the service answers
+# with 429 every worker stops for the time it asked for.
+
+import fcntl
+import itertools
+import json
+import os
+import time
+
+from flask import has_request_context
+
+import cooperative
+import metrics
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+SETTINGS = {
+    "WDQS_LIMITER_PATH": os.path.join(os.path.dirname(os.path.abspath(__file__)), "wdqs.limiter"),
+    # Queries in flight at the same time, the service allows five per client
+    "WDQS_MAX_CONCURRENT": 5,
+    "WDQS_PER_MINUTE": 60,
+    "WDQS_BURST": 10,
+    # Seconds a caller waits for a slot before giving up
+    "WDQS_INTERACTIVE_DEADLINE": 10,
+    "WDQS_BACKGROUND_DEADLINE": 300,
+    # Seconds after which the slot of a query is freed, even if it was not
+    # released, e.g. because its process died
+    "WDQS_LEASE": 120,
+}
+POLL = 0.05
+_IDS = itertools.count()
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after):
+        super(Throttled, self).__init__("Too many queries to the Wikidata Query Service")
+        self.retry_after = retry_after
+
+
+def configure(config):
+    for key in SETTINGS:
+        if key in config:
+            SETTINGS[key] = config[key]
+
+
+def _update(change):
+    # Runs change(state, now) with the state of all the workers locked
+    with open(SETTINGS["WDQS_LIMITER_PATH"], "a+") as file:
+        cooperative.call(fcntl.flock, file, fcntl.LOCK_EX)
+        try:
+            file.seek(0)
+            try:
+                state = json.loads(file.read())
+            except ValueError:
+                state = {}
+            now = time.time()
+            state.setdefault("tokens", float(SETTINGS["WDQS_BURST"]))
+            state.setdefault("refilled", now)
+            state.setdefault("paused_until", 0)
+            state["leases"] = dict((id_, expires) for id_, expires in state.get("leases", {}).items() if expires > now)
+            state["waiting"] = dict((id_, expires) for id_, expires in state.get("waiting", {}).items() if expires > now)
+            rate = SETTINGS["WDQS_PER_MINUTE"] / 60.0
+            state["tokens"] = min(float(SETTINGS["WDQS_BURST"]), state["tokens"] + (now - state["refilled"]) * rate)
+            state["refilled"] = now
+            result = change(state, now)
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(state))
+            # Written before the lock is released
+            file.flush()
+            return result
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def current_priority():
+    return INTERACTIVE if has_request_context() else BACKGROUND
+
+
+def deadline_for(priority=None):
+    # Seconds a caller of this priority waits for the service
+    if priority is None:
+        priority = current_priority()
+    return SETTINGS["WDQS_INTERACTIVE_DEADLINE" if priority == INTERACTIVE else "WDQS_BACKGROUND_DEADLINE"]
+
+
+def acquire(priority=None, deadline=None):
+    # Returns the id of the slot, to be released after the query
+    if priority is None:
+        priority = current_priority()
+    if deadline is None:
+        deadline = deadline_for(priority)
+    id_ = "%d-%d" % (os.getpid(), next(_IDS))
+    started = time.time()
+
+    def take(state, now):
+        if now < state["paused_until"]:
+            return state["paused_until"] - now
+        # Background queries wait while a request is waiting
+        blocked = priority == BACKGROUND and any(waiter != id_ for waiter in state["waiting"])
+        if not blocked and state["tokens"] >= 1 and len(state["leases"]) < SETTINGS["WDQS_MAX_CONCURRENT"]:
+            state["tokens"] -= 1
+            state["leases"][id_] = now + SETTINGS["WDQS_LEASE"]
+            state["waiting"].pop(id_, None)
+            return 0
+        if priority == INTERACTIVE:
+            state["waiting"][id_] = now + 1
+        return max((1 - state["tokens"]) * 60.0 / SETTINGS["WDQS_PER_MINUTE"], POLL)
+
+    while True:
+        wait = _update(take)
+        if not wait:
+            metrics.REGISTRY.observe("povoconta_wdqs_queue_seconds", {"priority": priority}, time.time() - started,
+                                     "Time the queries waited for the rate limiter of the Wikidata Query Service")
+            return id_
+        left = started + deadline - time.time()
+        if left <= 0:
+            _update(lambda state, now: state["waiting"].pop(id_, None))
+            metrics.REGISTRY.inc("povoconta_wdqs_throttled_total", {"priority": priority}, 1,
+                                 "Queries given up after waiting for the rate limiter")
+            raise Throttled(wait)
+        time.sleep(min(wait, POLL if priority == INTERACTIVE else 1, left))
+
+
+def release(id_):
+    _update(lambda state, now: state["leases"].pop(id_, None))
+
+
+def pause(seconds):
+    # Called when the service answers with 429: no worker sends queries for a while
+    def change(state, now):
+        state["paused_until"] = max(state["paused_until"], now + seconds)
+        state["tokens"] = 0.0
+
+    _update(change)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# On-disk cache of the images of the works. Each file is fetched from
+# Wikimedia Commons once, resized with Pillow to the widths used by the
+# pages, in JPEG (or PNG, for images with transparency) and WebP, and the
+# least recently used variants are evicted when the cache grows too big.
+# The requests for a file that is not in the cache yet, made at the same time
+# by any of the workers, download it once.
+
+import hashlib
+import io
+import logging
+import os
+import threading
+from urllib.parse import quote
+
+from PIL import Image
+
+import coalesce
+import http_client
+import metrics
+import throttle
+
+LOGGER = logging.getLogger(__name__)
+COMMONS_FILEPATH = "https://commons.wikimedia.org/wiki/Special:FilePath/"
+SOURCE_WIDTH = 2000
+WIDTHS = (300, 500, 2000)
+MIMETYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+class ThumbnailCache(object):
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.etags = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def key(self, filename):
+        return hashlib.sha1(filename.encode("utf-8")).hexdigest()
+
+    def path(self, filename, width, format_):
+        return os.path.join(self.directory, "%s_%d.%s" % (self.key(filename), width, format_))
+
+    def source_path(self, filename):
+        return os.path.join(self.directory, "%s_source" % self.key(filename))
+
+    def get(self, filename, width, webp=False):
+        # Returns the path, mimetype and etag of the variant, creating it if needed
+        for format_ in (("webp",) if webp else ("jpeg", "png")):
+            path = self.path(filename, width, format_)
+            if os.path.exists(path):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return path, MIMETYPES[format_], self.etag(path)
+        return self.create(filename, width, webp)
+
+    def fetch(self, filename):
+        path = self.source_path(filename)
+        if not os.path.exists(path):
+            coalesce.run("commons " + filename, lambda: self.download(filename, path),
+                         deadline=throttle.deadline_for())
+        with open(path, "rb") as file:
+            return file.read()
+
+    def download(self, filename, path):
+        response = metrics.timed("commons", "thumbnail", http_client.get, COMMONS_FILEPATH + quote(filename),
+                                 params={"width": SOURCE_WIDTH})
+        response.raise_for_status()
+        self.write(path, response.content)
+        return path
+
+    def create(self, filename, width, webp):
+        image = Image.open(io.BytesIO(self.fetch(filename)))
+        image.load()
+        transparent = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        image.thumbnail((width, image.height), Image.LANCZOS)
+
+        output = io.BytesIO()
+        if webp:
+            format_ = "webp"
+            image.save(output, "WEBP", quality=80, method=4)
+        elif transparent:
+            format_ = "png"
+            image.save(output, "PNG", optimize=True)
+        else:
+            format_ = "jpeg"
+            image.convert("RGB").save(output, "JPEG", quality=85, optimize=True, progressive=True)
+
+        content = output.getvalue()
+        path = self.path(filename, width, format_)
+        self.write(path, content)
+        self.etags[path] = hashlib.sha1(content).hexdigest()
+        return path, MIMETYPES[format_], self.etags[path]
+
+    def etag(self, path):
+        if path not in self.etags:
+            with open(path, "rb") as file:
+                self.etags[path] = hashlib.sha1(file.read()).hexdigest()
+        return self.etags[path]
+
+    def write(self, path, content):
+        temporary = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(temporary, "wb") as file:
+            file.write(content)
+        with self.lock:
+            # A file written again replaces the previous one
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(temporary, path)
+            self.size += len(content) - replaced
+            evict = self.size > self.max_bytes
+        if evict:
+            self.evict()
+
+    def evict(self):
+        # Other processes may share the directory, so its real content is
+        # read before removing the least recently used files
+        with self.lock:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")]
+            entries = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries))
+            size = sum(entry[1] for entry in entries)
+            target = self.max_bytes * 0.9
+            for mtime, file_size, path in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.etags.pop(path, None)
+                size -= file_size
+            self.size = size
+            LOGGER.info("Thumbnail cache evicted down to %d bytes", size)
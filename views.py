@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the "Wiki Museu do Ipiranga - Quantos tem?" wikitool
+#
+# Precomputed aggregates of the facet pages. Every view is built for each of
+# its keys (usually the languages of the interface) by a background thread,
+# and all of them are published together as a new versioned snapshot, which
+# replaces the previous one in a single assignment. Requests only read the
+# current snapshot.
+
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Snapshot(object):
+    __slots__ = ("version", "built", "views")
+
+    def __init__(self, version, views):
+        self.version = version
+        self.built = time.time()
+        # (name, key) -> result of the builder
+        self.views = views
+
+
+class MaterializedViews(object):
+    def __init__(self):
+        self.definitions = {}
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def define(self, name, builder, keys=(None,)):
+        self.definitions[name] = (builder, tuple(keys))
+
+    def get(self, name, key=None):
+        # None while the view is not built yet, the requests never build it themselves
+        snapshot = self.snapshot
+        if snapshot is not None:
+            return snapshot.views.get((name, key))
+        return None
+
+    def refresh(self):
+        with self.lock:
+            started = time.time()
+            previous = self.snapshot
+            views = {}
+            for name, (builder, keys) in self.definitions.items():
+                for key in keys:
+                    try:
+                        views[name, key] = builder(key) if key is not None else builder()
+                    except Exception:
+                        LOGGER.exception("Could not build the view %s for %s", name, key)
+                        # A view that fails keeps its previous value
+                        if previous is not None and (name, key) in previous.views:
+                            views[name, key] = previous.views[name, key]
+            self.snapshot = Snapshot(previous.version + 1 if previous is not None else 1, views)
+            LOGGER.info("Views snapshot %d built in %.1fs", self.snapshot.version, time.time() - started)
+        return self.snapshot
+
+    def invalidate(self):
+        # Asks the scheduler for a new snapshot now, e.g. after the catalog changed
+        self.wakeup.set()
+
+    def start(self, interval=600):
+        def run():
+            while True:
+                self.refresh()
+                self.wakeup.wait(interval)
+                self.wakeup.clear()
+
+        thread = threading.Thread(target=run, name="views", daemon=True)
+        thread.start()
+        return thread
@@ -5,47 +5,84 @@
 # "depicts" under the GPL-3 license. Some modifications were made due
 # to variable names
 
+import threading
+import time
+from collections import OrderedDict
+
 from flask import current_app, session
 from requests_oauthlib import OAuth1Session
 from urllib.parse import urlencode
 
+import metrics
 
-def api_post_request(params):
-    app = current_app
-    url = 'https://www.wikidata.org/w/api.php'
-    client_key = app.config['CONSUMER_KEY']
-    client_secret = app.config['CONSUMER_SECRET']
-    oauth = OAuth1Session(client_key,
-                          client_secret=client_secret,
-                          resource_owner_key=session['owner_key'],
-                          resource_owner_secret=session['owner_secret'])
-    return oauth.post(url, data=params, timeout=4)
+WIKIDATA_API_ENDPOINT = 'https://www.wikidata.org/w/api.php'
+# Signed sessions of the users, kept with their connections between requests:
+# owner key -> (session, owner secret, last use), least recently used first
+SESSIONS = OrderedDict()
+SESSIONS_LOCK = threading.Lock()
 
 
-def raw_request(params):
+def oauth_session(credentials=None):
     app = current_app
-    url = 'https://www.wikidata.org/w/api.php?' + urlencode(params)
-    client_key = app.config['CONSUMER_KEY']
-    client_secret = app.config['CONSUMER_SECRET']
-    oauth = OAuth1Session(client_key,
-                          client_secret=client_secret,
-                          resource_owner_key=session['owner_key'],
-                          resource_owner_secret=session['owner_secret'])
-    return oauth.get(url, timeout=4)
-
-
-def api_request(params):
-    return raw_request(params).json()
-
-
-def get_token():
+    if credentials is None:
+        credentials = session['owner_key'], session['owner_secret']
+    owner_key, owner_secret = credentials
+    now = time.time()
+    idle = app.config.get('OAUTH_SESSION_IDLE', 600)
+    closed = []
+    with SESSIONS_LOCK:
+        while SESSIONS:
+            key, (oauth, secret, used) = next(iter(SESSIONS.items()))
+            if now - used < idle and len(SESSIONS) <= app.config.get('OAUTH_SESSION_MAX', 256):
+                break
+            del SESSIONS[key]
+            closed.append(oauth)
+        entry = SESSIONS.get(owner_key)
+        if entry is None or entry[1] != owner_secret:
+            oauth = OAuth1Session(app.config['CONSUMER_KEY'],
+                                  client_secret=app.config['CONSUMER_SECRET'],
+                                  resource_owner_key=owner_key,
+                                  resource_owner_secret=owner_secret)
+        else:
+            oauth = entry[0]
+        SESSIONS[owner_key] = (oauth, owner_secret, now)
+        SESSIONS.move_to_end(owner_key)
+    for oauth_ in closed:
+        oauth_.close()
+    return oauth
+
+
+def forget_session(owner_key):
+    with SESSIONS_LOCK:
+        entry = SESSIONS.pop(owner_key, None)
+    if entry is not None:
+        entry[0].close()
+
+
+def api_post_request(params, credentials=None):
+    oauth = oauth_session(credentials)
+    return metrics.timed("oauth", params.get("meta", params.get("action")), oauth.post, WIKIDATA_API_ENDPOINT,
+                         data=params, timeout=4)
+
+
+def raw_request(params, credentials=None):
+    url = WIKIDATA_API_ENDPOINT + '?' + urlencode(params)
+    oauth = oauth_session(credentials)
+    return metrics.timed("oauth", params.get("meta", params.get("action")), oauth.get, url, timeout=4)
+
+
+def api_request(params, credentials=None):
+    return raw_request(params, credentials).json()
+
+
+def get_token(credentials=None):
     params = {
         'action': 'query',
         'meta': 'tokens',
         'format': 'json',
         'formatversion': 2,
     }
-    reply = api_request(params)
+    reply = api_request(params, credentials)
     token = reply['query']['tokens']['csrftoken']
     return token
 